@@ -0,0 +1,40 @@
+# coding=utf-8
+"""Compares hashing every subscriber's channel id against the memoised lookup
+
+Resolving channel ids is on the hot path of every template render and every
+private question/answer publish. Run from the project root with an
+instance/config.py in place:
+
+    python -m benchmarks.bench_sse_channels
+"""
+import timeit
+from importlib import import_module
+from typing import NamedTuple
+
+# event_app.views re-exports the `sse` blueprint under the module's name, so fetch the module itself
+sse_views = import_module('event_app.views.sse')
+
+SUBSCRIBERS = 1000
+ITERATIONS = 100
+
+
+class FakeUser(NamedTuple):
+    email: str
+
+
+def main() -> None:
+    users = [FakeUser(f"user{i}@example.com") for i in range(SUBSCRIBERS)]
+    for user in users:
+        sse_views.get_channel(user)  # Warm the memo
+
+    cases = {
+        "hashed": lambda: [sse_views.hash_channel(user.email) for user in users],
+        "memoised": lambda: [sse_views.get_channel(user) for user in users]
+    }
+    for name, fan_out in cases.items():
+        seconds = timeit.timeit(fan_out, number=ITERATIONS)
+        print(f"{name:>9}: {seconds / ITERATIONS * 1e3:8.3f} ms per {SUBSCRIBERS} subscribers")
+
+
+if __name__ == '__main__':
+    main()
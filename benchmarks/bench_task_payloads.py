@@ -0,0 +1,53 @@
+# coding=utf-8
+"""Compares the size and enqueue latency of RQ job payloads
+
+Queues tasks.notify with pickled ORM instances (how it used to be queued)
+and with the ids it takes now, onto a queue no worker listens on, against
+the configured redis. Run from the project root with an instance/config.py
+in place:
+
+    python -m benchmarks.bench_task_payloads
+"""
+import timeit
+from datetime import datetime
+
+from event_app import models, tasks
+from event_app.app import create_app
+from event_app.configs import TestingConfig
+from event_app.extensions import db, redis_queue
+
+ITERATIONS = 1000
+QUEUE = 'benchmark'
+
+
+class BenchmarkConfig(TestingConfig):
+    RQ_ASYNC = True  # Only enqueue, the testing config runs jobs immediately
+
+
+def main() -> None:
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        owner = models.User("owner", "owner@example.com", "password123")
+        event = models.Event(owner=owner, name="Benchmark", description="An event" * 50, start=datetime.utcnow())
+        message = models.EventMessage(event=event, type=models.MessageTypes.TEXT, data={"message": "Hello" * 20})
+        db.session.add_all([owner, event, message])
+        db.session.commit()
+        event.subscriptions, event.owner  # Loaded relationships get pickled too
+
+        payloads = {
+            "orm instances": (message, event),
+            "ids": ("message", message.id)
+        }
+        try:
+            for name, args in payloads.items():
+                job = tasks.notify.queue(*args, queue=QUEUE)
+                size = len(redis_queue.connection.hget(job.key, 'data'))
+                seconds = timeit.timeit(lambda: tasks.notify.queue(*args, queue=QUEUE), number=ITERATIONS)
+                print(f"{name:>14}: {size:>6} bytes, {seconds / ITERATIONS * 1e6:8.2f} µs per enqueue")
+        finally:
+            redis_queue.get_queue(QUEUE).empty()
+
+
+if __name__ == '__main__':
+    main()
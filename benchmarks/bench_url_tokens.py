@@ -0,0 +1,37 @@
+# coding=utf-8
+"""Compares building a Hashids encoder per url token against the shared codec
+
+Encodes the tokens for 1,000 discover cards, as rendering the page does. Run
+from the project root:
+
+    python -m benchmarks.bench_url_tokens
+"""
+import timeit
+
+import flask
+import hashids
+
+from event_app.cache import UrlTokenCodec
+
+CARDS = 1000
+ITERATIONS = 20
+
+
+def main() -> None:
+    app = flask.Flask(__name__)
+    app.config.update(HASHID_SALT="benchmark", URL_TOKEN_CACHE_SIZE=4096)
+    codec = UrlTokenCodec(app)
+    ids = range(1, CARDS + 1)
+
+    cases = {
+        "per call": lambda: [hashids.Hashids(min_length=10, salt="benchmark").encode(id_) for id_ in ids],
+        "shared encoder": lambda: [codec.encoder.encode(id_) for id_ in ids],
+        "memoised": lambda: [codec.encode(id_) for id_ in ids]
+    }
+    for name, render in cases.items():
+        seconds = timeit.timeit(render, number=ITERATIONS)
+        print(f"{name:>14}: {seconds / ITERATIONS * 1e3:8.3f} ms per {CARDS} cards")
+
+
+if __name__ == '__main__':
+    main()
@@ -36,7 +36,6 @@ def create_app(config_object: Type[configs.Config] = configs.ProductionConfig) -
 
 def register_extensions(app: flask.app.Flask) -> None:
     """Register All Flask Extensions"""
-    extensions.bcrypt.init_app(app)
     extensions.db.init_app(app)
     extensions.login_manager.init_app(app)
     extensions.mail.init_app(app)
@@ -45,9 +44,13 @@ def register_extensions(app: flask.app.Flask) -> None:
     extensions.redis_store.init_app(app)
     extensions.limiter.init_app(app)
     extensions.humanise.init_app(app)
+    extensions.discover_cache.init_app(app)
+    extensions.push_sender.init_app(app)
+    extensions.url_tokens.init_app(app)
+    extensions.password_hasher.init_app(app)
 
     # Set up user loader
-    extensions.login_manager.user_loader(lambda token: models.User.query.filter_by(session_token=token).first())
+    extensions.login_manager.user_loader(models.User.load_by_session_token)
 
 
 def register_blueprints(app: flask.app.Flask) -> None:
@@ -63,6 +66,11 @@ def register_commands(app: flask.app.Flask) -> None:
     app.cli.add_command(commands.build_database)
     app.cli.add_command(commands.populate_database)
     app.cli.add_command(commands.generate_markov)
+    app.cli.add_command(commands.rebuild_unread_counters)
+    app.cli.add_command(commands.mail_worker)
+    app.cli.add_command(commands.run_sse_server)
+    app.cli.add_command(commands.rerender_markdown)
+    app.cli.add_command(commands.schedule_jobs)
 
 
 def register_shellcontext(app: flask.app.Flask) -> None:
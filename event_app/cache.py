@@ -0,0 +1,175 @@
+# coding=utf-8
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, NamedTuple, Optional
+
+import flask
+import hashids
+
+from . import geo
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded in-process mapping which evicts the least recently used entry
+
+    Entries optionally expire after `ttl` seconds. Safe to share between threads.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def discard_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Removes every entry whose key matches the predicate"""
+        with self._lock:
+            stale = [key for key in self._data if predicate(key)]
+            for key in stale:
+                del self._data[key]
+        return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+
+class DiscoverKey(NamedTuple):
+    cell: Optional[str]  # None if the query doesn't depend on location
+    max_distance: Optional[float]
+    order: Optional[str]
+    cursor: Optional[str] = None
+
+
+class DiscoverCache(LRUCache):
+    """Caches pages of discover results by geohash cell
+
+    Values are (event ids, next page cursor).
+
+    Every user in a cell is served the results for the centre of that cell,
+    so neighbours share entries. Each gunicorn worker holds its own cache,
+    which is why entries also expire after DISCOVER_CACHE_TTL.
+    """
+
+    def __init__(self, app: Optional[flask.Flask] = None):
+        super().__init__()
+        self.precision = 6
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: flask.Flask) -> None:
+        self.maxsize = app.config['DISCOVER_CACHE_SIZE']
+        self.ttl = app.config['DISCOVER_CACHE_TTL']
+        self.precision = app.config['DISCOVER_CACHE_PRECISION']
+        app.extensions['discover_cache'] = self
+
+    def cell(self, latitude, longitude) -> str:
+        return geo.encode_geohash(latitude, longitude, self.precision)
+
+    def invalidate(self, latitude, longitude) -> int:
+        """Drops every entry that a new event at this location could appear in"""
+
+        def affected(key: DiscoverKey) -> bool:
+            if key.cell is None or key.max_distance is None:
+                return True
+            lat, lng, lat_error, lng_error = geo.decode_geohash(key.cell)
+            cell_radius = geo.great_circle_distance(lat, lng, lat + lat_error, lng + lng_error)
+            return geo.great_circle_distance(lat, lng, latitude, longitude) <= key.max_distance + cell_radius
+
+        return self.discard_where(affected)
+
+
+class UrlTokenCodec:
+    """Converts event ids to and from the hashids tokens used in urls
+
+    Building a Hashids encoder reshuffles its alphabet, so one is built per app on first use.
+    Recently used ids and tokens are memoised in both directions.
+    """
+
+    MIN_LENGTH = 10
+
+    def __init__(self, app: Optional[flask.Flask] = None):
+        self.salt: Optional[str] = None
+        self.tokens = LRUCache()
+        self.ids = LRUCache()
+        self._encoder: Optional[hashids.Hashids] = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: flask.Flask) -> None:
+        self.salt = app.config["HASHID_SALT"]
+        self.tokens = LRUCache(maxsize=app.config['URL_TOKEN_CACHE_SIZE'])
+        self.ids = LRUCache(maxsize=app.config['URL_TOKEN_CACHE_SIZE'])
+        self._encoder = None
+        app.extensions['url_tokens'] = self
+
+    @property
+    def encoder(self) -> hashids.Hashids:
+        with self._lock:
+            if self._encoder is None:
+                self._encoder = hashids.Hashids(min_length=self.MIN_LENGTH, salt=self.salt)
+            return self._encoder
+
+    def encode(self, id_: int) -> str:
+        token = self.tokens.get(id_)
+        if token is None:
+            token = self.encoder.encode(id_)
+            self.tokens.set(id_, token)
+            self.ids.set(token, id_)
+        return token
+
+    def decode(self, token: str) -> Optional[int]:
+        """The id a token refers to, or None if it isn't a valid token"""
+        id_ = self.ids.get(token)
+        if id_ is None:
+            decoded = self.encoder.decode(token)
+            if len(decoded) != 1:
+                return None
+            id_ = decoded[0]
+            self.ids.set(token, id_)
+            self.tokens.set(id_, token)
+        return id_
@@ -1,12 +1,15 @@
 # coding=utf-8
 import os
 import random
+from typing import Optional
 
 import click
 import faker
+import flask
 from flask.cli import with_appcontext
+from sqlalchemy import and_, func
 
-from . import extensions, models, utils
+from . import extensions, mailer, models, rendering, tasks, utils
 
 fake = faker.Faker()
 
@@ -73,3 +76,71 @@ def generate_markov(corpus, output) -> None:
     data = extensions.EventNameMarkov(corpus.read()).to_json()
     output.write(data)
     click.secho("Markov Chain Generated", fg="green", bold=True)
+
+
+@click.command()
+@with_appcontext
+def rebuild_unread_counters() -> None:
+    """Rebuilds the redis unread message counters from the database.
+
+    Increments made while this runs may be lost, so run it when traffic is quiet."""
+    Subscription = models.Subscription
+    Subscription.flush_last_viewed()
+    counts = extensions.db.session.query(
+            Subscription.user_id, Subscription.event_id, func.count(models.EventMessage.id)
+    ).join(models.EventMessage, and_(
+            models.EventMessage.event_id == Subscription.event_id,
+            models.EventMessage.timestamp > Subscription.last_viewed
+    )).group_by(Subscription.user_id, Subscription.event_id)
+
+    pipeline = extensions.redis_store.pipeline()
+    for key in extensions.redis_store.scan_iter(Subscription.unread_counter_key('*')):
+        pipeline.delete(key)
+    total = 0
+    for user_id, event_id, count in counts:
+        pipeline.hset(Subscription.unread_counter_key(user_id), event_id, count)
+        total += count
+    pipeline.execute()
+    click.secho(f"Rebuilt Counters For {total} Unread Messages", fg="green", bold=True)
+
+
+@click.command()
+@with_appcontext
+@click.option('--batch-size', type=click.IntRange(1), help="Maximum emails sent per batch")
+@click.option('--flush-interval', type=float, help="Seconds to wait for a batch to fill")
+def mail_worker(batch_size: int, flush_interval: float) -> None:
+    """Sends queued emails in batches over one SMTP connection."""
+    config = flask.current_app.config
+    batch_size = batch_size or config['MAIL_BATCH_SIZE']
+    flush_interval = flush_interval if flush_interval is not None else config['MAIL_FLUSH_INTERVAL']
+    click.secho(f"Mail Worker Started (batches of {batch_size}, every {flush_interval}s)", fg="green", bold=True)
+    mailer.run_worker(batch_size, flush_interval)
+
+
+@click.command()
+@with_appcontext
+@click.option('--host', default="127.0.0.1")
+@click.option('--port', default=8001)
+def run_sse_server(host: str, port: int) -> None:
+    """Runs the asynchronous server sent events stream."""
+    from . import sse_server  # aiohttp is only needed by the stream server
+    sse_server.run(flask.current_app._get_current_object(), host, port)
+
+
+@click.command()
+@with_appcontext
+@click.option('--workers', type=click.IntRange(1), default=None, help="Processes, defaults to one per CPU")
+def rerender_markdown(workers: Optional[int]) -> None:
+    """Re-renders event descriptions and messages from their markdown, after changing the sanitiser whitelist."""
+    click.secho("Re-rendering Markdown...", fg="yellow")
+    updated = rendering.rerender_all(workers)
+    click.secho(f"Re-rendered {updated} descriptions and messages", fg="green", bold=True)
+
+
+@click.command()
+@with_appcontext
+def schedule_jobs() -> None:
+    """Schedules the periodic jobs run by `flask rq scheduler`."""
+    config = flask.current_app.config
+    tasks.flush_last_viewed.cron(config['LAST_VIEWED_FLUSH_CRON'], 'flush-last-viewed')
+    click.secho("Periodic Jobs Scheduled", fg="green", bold=True)
@@ -5,7 +5,11 @@ import os
 
 class Config:
     """Base Configuration"""
-    BCRYPT_LOG_ROUNDS = 14
+    BCRYPT_LOG_ROUNDS = 14  # Minimum, raised at startup on machines that hash faster than PASSWORD_HASH_TARGET_TIME
+    PASSWORD_HASH_MAX_ROUNDS = 16
+    PASSWORD_HASH_TARGET_TIME = 1.0  # Seconds per hash, None to always use BCRYPT_LOG_ROUNDS
+    PASSWORD_HASH_WORKERS = 2  # Processes per gunicorn worker, 0 hashes on the request thread
+    PASSWORD_HASH_QUEUE_LIMIT = 8  # Hashes in flight per gunicorn worker
     DEBUG_TB_INTERCEPT_REDIRECTS = False
     DEBUG_TB_TEMPLATE_EDITOR_ENABLED = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
@@ -14,6 +18,9 @@ class Config:
     MAIL_USERNAME = 'event.app.notifier@gmail.com'
     MAIL_USE_TLS = False
     MAIL_USE_SSL = True
+    MAIL_OUTBOX_ENABLED = False  # Queue emails for `flask mail_worker` rather than RQ
+    MAIL_BATCH_SIZE = 100  # Emails
+    MAIL_FLUSH_INTERVAL = 5  # Seconds
     REDIS_URL = "redis://localhost:6379/0"
     RQ_REDIS_URL = REDIS_URL
     RATELIMIT_STORAGE_URL = REDIS_URL
@@ -28,15 +35,45 @@ class Config:
 
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 Mb
     UPLOAD_FOLDER = "uploads"  # Relative to static folder
+    IMAGE_SPOOL_FOLDER = "spool"  # Relative to instance folder, uploads wait here to be processed
+    IMAGE_ORIGINALS_FOLDER = "originals"  # Relative to instance folder, uploads as received, never served
+    IMAGE_WIDTHS = (320, 640, 800, 1280)  # Pixels, each stored as JPEG and WebP
     ALLOWED_IMAGE_MIMETYPES = {'image/jpeg', 'image/png'}
 
     LOCKDOWN_AFTER_N_PASSWORD_ATTEMPTS = 10
     LOCKDOWN_FOR_N_SECONDS = 30 * 60  # 30 Minutes
+    RECOVERY_LOCKOUT_ATTEMPTS = 5  # Per recovery token, which then stays locked until it expires
 
     DEFAULT_EVENT_NEARBY_DISTANCE = 10  # Km
     DEFAULT_EVENT_MEDIUM_DISTANCE = 30  # Km
     DEFAULT_EVENT_MAXIMUM_DISTANCE = 50  # Km
 
+    DISCOVER_PAGE_SIZE = 20  # Events
+    MAP_MARKER_LIMIT = 200  # Events
+
+    DISCOVER_CACHE_SIZE = 1024  # Entries
+    DISCOVER_CACHE_TTL = 60  # Seconds
+    DISCOVER_CACHE_PRECISION = 6  # Geohash characters, ~1.2 x 0.6 Km cells
+    URL_TOKEN_CACHE_SIZE = 4096  # Event ids memoised in each direction
+    EVENT_REF_TTL = 24 * 60 * 60  # Seconds
+    USER_SNAPSHOT_TTL = 5 * 60  # Seconds
+    MARKDOWN_CACHE_TTL = 24 * 60 * 60  # Seconds
+    FRAGMENT_CACHE_TTL = 5 * 60  # Seconds, also how stale the relative times in a fragment can get
+
+    NOTIFICATION_CHUNK_SIZE = 500  # Recipients per email/push job
+    WEB_PUSH_SUBJECT = "mailto:chadfield.jackson@gmail.com"
+    WEB_PUSH_CONCURRENCY = 16  # Concurrent requests per worker
+    WEB_PUSH_TIMEOUT = 10  # Seconds
+
+    SSE_HEARTBEAT_INTERVAL = 15  # Seconds
+    SSE_CLIENT_QUEUE_SIZE = 100  # Events buffered per client before it is dropped
+    SSE_REPLAY_SIZE = 200  # Events kept per channel for reconnecting clients
+    SSE_REPLAY_TTL = 60 * 60  # Seconds
+
+    MESSAGE_PAGE_SIZE = 20  # Messages, older ones load on demand
+    LAST_VIEWED_FLUSH_CRON = "* * * * *"  # Buffered last viewed times are written to the database every minute
+    LAST_VIEWED_FLUSH_BATCH_SIZE = 500  # Users per UPDATE batch
+
     MESSAGE_BREAK_AFTER_DELTA = datetime.timedelta(days=1)
 
     APP_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -49,6 +86,7 @@ class ProductionConfig(Config):
     SERVER_NAME = "vent.local:8000"
     MAIL_DEFAULT_SENDER = "Event App Notifier"
     SEND_EMAILS = True
+    MAIL_OUTBOX_ENABLED = True
     RATELIMIT_ENABLED = True
 
 
@@ -57,6 +95,7 @@ class DevelopmentConfig(Config):
     DEBUG = True
     MAIL_DEFAULT_SENDER = "Event App Notifier <Development>"
     SEND_EMAILS = True
+    MAIL_OUTBOX_ENABLED = True
     SERVER_NAME = "vent.local:8000"
     RATELIMIT_ENABLED = False
     SQLALCHEMY_POOL_SIZESQLALCHEMY_POOL_SIZE = 15
@@ -69,6 +108,8 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     WTF_CSRF_ENABLED = False
     BCRYPT_LOG_ROUNDS = 4
+    PASSWORD_HASH_TARGET_TIME = None
+    PASSWORD_HASH_WORKERS = 0
     RATELIMIT_ENABLED = False
     RQ_ASYNC = False
     MAIL_DEFAULT_SENDER = "Event App Notifier <Testing>"
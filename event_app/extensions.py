@@ -3,7 +3,6 @@ import bleach
 import flask_login
 import flask_mail
 import markovify
-from flask_bcrypt import Bcrypt
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_humanize import Humanize
 from flask_limiter import Limiter
@@ -13,7 +12,10 @@ from flask_redis import FlaskRedis
 from flask_rq2 import RQ
 from flask_sqlalchemy import SQLAlchemy
 
-bcrypt = Bcrypt()
+from .cache import DiscoverCache, UrlTokenCodec
+from .hashing import PasswordHasher
+from .push import PushSender
+
 db = SQLAlchemy()
 login_manager = flask_login.LoginManager()
 mail = flask_mail.Mail()
@@ -23,6 +25,10 @@ redis_store = FlaskRedis()
 limiter = Limiter(key_func=get_remote_address)
 paranoid = Paranoid()
 humanise = Humanize()
+discover_cache = DiscoverCache()
+push_sender = PushSender()
+url_tokens = UrlTokenCodec()
+password_hasher = PasswordHasher()
 
 login_manager.login_view = "users.login"
 login_manager.login_message = "Please log in to access this page."
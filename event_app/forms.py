@@ -5,7 +5,7 @@ import wtforms
 from flask_wtf import FlaskForm, RecaptchaField
 from wtforms import ValidationError
 
-from .extensions import bcrypt
+from .extensions import db, password_hasher
 from .models import User
 
 
@@ -31,11 +31,12 @@ class LoginForm(FlaskForm):
         user = User.query.filter_by(email=self.email.data).first()
         if user is None:
             # Hash random password anyways in an attempt to prevent timing attack
-            bcrypt.generate_password_hash('lol random password' + 'random salt')
+            password_hasher.dummy_check(self.password.data)
             self.password.errors.append("Unknown Username Or Password")
             return False
         else:
             if user.check_password(self.password.data):
+                db.session.commit()  # In case the password was rehashed
                 self.user = user
                 return True
             else:
@@ -0,0 +1,59 @@
+# coding=utf-8
+"""Caches rendered parts of the event page that are the same for every viewer
+
+Fragments are keyed by a per-event version which is bumped whenever a message or answer changes,
+so a stale fragment is never served, it just expires.
+"""
+import json
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
+
+import flask
+from markupsafe import Markup
+
+from .extensions import redis_store
+
+
+class Fragment(NamedTuple):
+    html: Markup
+    count: int  # Items rendered
+
+
+class Piece(NamedTuple):
+    sort_key: List[Any]
+    html: Markup
+
+
+def version_key(event_id: int) -> str:
+    return 'EVENT:FRAGMENT_VERSION#{}'.format(event_id)
+
+
+def bump_version(event_id: int) -> None:
+    redis_store.incr(version_key(event_id))
+
+
+def _cached(event_id: int, name: str, variant: str, render: Callable[[], Any]) -> Any:
+    """Stored as JSON rather than pickled, so write access to redis can't run code in the app"""
+    version: Optional[bytes] = redis_store.get(version_key(event_id))
+    key = 'EVENT:FRAGMENT_JSON#{}:{}:{}:{}'.format(event_id, name, variant, (version or b"0").decode())
+    cached: Optional[bytes] = redis_store.get(key)
+    if cached is not None:
+        return json.loads(cached.decode())
+    value = render()
+    redis_store.set(key, json.dumps(value), ex=flask.current_app.config['FRAGMENT_CACHE_TTL'])
+    return value
+
+
+def cached_fragment(event_id: int, name: str, render: Callable[[], Tuple[str, int]], variant: str = "") -> Fragment:
+    """Returns the cached fragment, calling `render` for (html, count) on a miss"""
+    def render_json() -> List[Any]:
+        html_, count_ = render()
+        return [str(html_), count_]
+
+    html, count = _cached(event_id, name, variant, render_json)
+    return Fragment(Markup(html), count)
+
+
+def cached_pieces(event_id: int, name: str, render: Callable[[], List[Piece]], variant: str = "") -> List[Piece]:
+    """Like `cached_fragment`, but keeps each item separate so it can be merged in order with uncached ones"""
+    pieces = _cached(event_id, name, variant, lambda: [[sort_key, str(html)] for sort_key, html in render()])
+    return [Piece(sort_key, Markup(html)) for sort_key, html in pieces]
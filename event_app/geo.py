@@ -0,0 +1,74 @@
+# coding=utf-8
+import math
+from decimal import Decimal
+from typing import Tuple, Union
+
+EARTH_RADIUS = 6371  # Km
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_BASE32_INDEX = {char: index for index, char in enumerate(_BASE32)}
+
+Number = Union[float, Decimal]
+
+
+def great_circle_distance(lat_1: Number, lng_1: Number, lat_2: Number, lng_2: Number) -> float:
+    """Haversine distance between two points in Km"""
+    phi_1 = math.radians(lat_1)
+    phi_2 = math.radians(lat_2)
+    d_phi = phi_2 - phi_1
+    d_lambda = math.radians(lng_2) - math.radians(lng_1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi_1) * math.cos(phi_2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def encode_geohash(latitude: Number, longitude: Number, precision: int = 6) -> str:
+    """Quantises a location to the geohash cell containing it"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    latitude = float(latitude)
+    longitude = float(longitude)
+
+    cell = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(cell) < precision:
+        if even:
+            value, interval = longitude, lng_range
+        else:
+            value, interval = latitude, lat_range
+        middle = (interval[0] + interval[1]) / 2
+        if value >= middle:
+            bits = (bits << 1) | 1
+            interval[0] = middle
+        else:
+            bits <<= 1
+            interval[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            cell.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(cell)
+
+
+def decode_geohash(cell: str) -> Tuple[float, float, float, float]:
+    """Returns the centre of a geohash cell as (latitude, longitude, latitude_error, longitude_error)"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for char in cell:
+        bits = _BASE32_INDEX[char]
+        for shift in range(4, -1, -1):
+            interval = lng_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            if (bits >> shift) & 1:
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+    return ((lat_range[0] + lat_range[1]) / 2,
+            (lng_range[0] + lng_range[1]) / 2,
+            (lat_range[1] - lat_range[0]) / 2,
+            (lng_range[1] - lng_range[0]) / 2)
@@ -0,0 +1,113 @@
+# coding=utf-8
+import logging
+import math
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, Optional
+
+import bcrypt
+import flask
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords with bcrypt in a bounded process pool
+
+    Keeps seconds of CPU per login off the request thread. The work factor is calibrated when the app starts,
+    raising BCRYPT_LOG_ROUNDS while a hash takes less than PASSWORD_HASH_TARGET_TIME on this machine, it is never
+    lowered. With PASSWORD_HASH_WORKERS = 0 hashing happens in the calling thread.
+    """
+
+    def __init__(self, app: Optional[flask.Flask] = None):
+        self.min_rounds = 14
+        self.max_rounds = 16
+        self.target_time: Optional[float] = None
+        self.workers = 0
+        self.queue_limit = 1
+        self.queue_depth = 0
+        self.rounds = self.min_rounds
+        self._dummy_hash: Optional[bytes] = None
+        self._executor: Optional[Executor] = None
+        self._slots: Optional[threading.BoundedSemaphore] = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: flask.Flask) -> None:
+        self.min_rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.max_rounds = app.config['PASSWORD_HASH_MAX_ROUNDS']
+        self.target_time = app.config['PASSWORD_HASH_TARGET_TIME']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.queue_limit = app.config['PASSWORD_HASH_QUEUE_LIMIT']
+        self._slots = threading.BoundedSemaphore(self.queue_limit)
+        self.rounds = self.calibrate()
+        self._dummy_hash = None
+        app.extensions['password_hasher'] = self
+
+    def calibrate(self) -> int:
+        """Picks the work factor closest to the target time, each extra round doubles the cost
+
+        Only ever raises the cost above BCRYPT_LOG_ROUNDS, slower machines keep the minimum.
+        """
+        if self.target_time is None:
+            return self.min_rounds
+        start = time.perf_counter()
+        _hash(b"calibration", self.min_rounds)
+        elapsed = time.perf_counter() - start
+        extra_rounds = max(round(math.log2(self.target_time / elapsed)), 0)
+        rounds = min(self.min_rounds + extra_rounds, self.max_rounds)
+        logger.info("Password hashing calibrated to %d rounds (%.3fs at %d)", rounds, elapsed, self.min_rounds)
+        return rounds
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            logger.warning("Password hashing saturated, waiting for a slot: %s", self.stats)
+            self._slots.acquire()
+        with self._lock:
+            self.queue_depth += 1
+        try:
+            if self.workers == 0:
+                return function(*args)
+            return self.executor.submit(function, *args).result()
+        finally:
+            with self._lock:
+                self.queue_depth -= 1
+            self._slots.release()
+
+    @property
+    def executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def hash(self, password: str) -> bytes:
+        return self._run(_hash, password.encode(), self.rounds)
+
+    def check(self, password: str, hashed: bytes) -> bool:
+        return self._run(_check, password.encode(), hashed)
+
+    def dummy_check(self, password: str) -> None:
+        """Spends as long as a real check would, so unknown accounts can't be told apart by timing"""
+        if self._dummy_hash is None:
+            self._dummy_hash = self.hash("dummy password")
+        self.check(password, self._dummy_hash)
+
+    def needs_rehash(self, hashed: bytes) -> bool:
+        """True for hashes made with fewer rounds than are used now"""
+        return int(hashed.split(b'$')[2]) < self.rounds
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"rounds": self.rounds, "workers": self.workers, "queue_depth": self.queue_depth,
+                "queue_limit": self.queue_limit}
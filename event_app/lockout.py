@@ -0,0 +1,45 @@
+# coding=utf-8
+import flask
+
+from .extensions import redis_store
+
+
+class Lockout:
+    """Limits attempts at something guessable, like a password, locking it for a while after too many
+
+    Checking the count, counting the attempt and refreshing its expiry happen in one atomic script call,
+    so concurrent attempts can't race past the limit. Attempts are counted before they are checked,
+    call `reset` once one succeeds.
+    """
+
+    # KEYS: the attempt counter; ARGV: the limit, the lockout duration in seconds
+    # Returns 1 if the attempt may go ahead, or 0 if locked out
+    SCRIPT = """
+        local attempts = tonumber(redis.call('GET', KEYS[1]) or '0')
+        if attempts >= tonumber(ARGV[1]) then
+            return 0
+        end
+        redis.call('INCR', KEYS[1])
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        return 1
+    """
+
+    def __init__(self, key_format: str, limit_setting: str, duration_setting: str):
+        self.key_format = key_format
+        self.limit_setting = limit_setting
+        self.duration_setting = duration_setting
+
+    def attempt(self, identifier: str) -> bool:
+        """Counts an attempt, returning False if `identifier` is locked out"""
+        # Registered through the proxy each time so it runs on the current app's client, it's only hashed locally
+        script = redis_store.register_script(self.SCRIPT)
+        config = flask.current_app.config
+        return script(keys=[self.key_format.format(identifier)],
+                      args=[config[self.limit_setting], config[self.duration_setting]]) == 1
+
+    def reset(self, identifier: str) -> None:
+        redis_store.delete(self.key_format.format(identifier))
+
+
+login_lockout = Lockout('USER:LOGIN_FAILURES#{}', 'LOCKDOWN_AFTER_N_PASSWORD_ATTEMPTS', 'LOCKDOWN_FOR_N_SECONDS')
+recovery_lockout = Lockout('USER:RECOVERY_FAILURES#{}', 'RECOVERY_LOCKOUT_ATTEMPTS', 'RECOVERY_TOKEN_EXPIRY')
@@ -0,0 +1,184 @@
+# coding=utf-8
+import pickle
+import smtplib
+import time
+from typing import Callable, List, Optional
+
+import flask
+import flask_mail
+
+from .extensions import mail, redis_store
+
+OUTBOX_KEY = 'MAIL:OUTBOX'
+PROCESSING_KEY = 'MAIL:PROCESSING'
+
+
+class BatchMailer:
+    """Sends many emails over one SMTP connection
+
+    The connection is opened on first use and re-established once if the
+    server drops it mid-batch.
+    """
+
+    def __init__(self, mail_: flask_mail.Mail = mail):
+        self.mail = mail_
+        self.connection: Optional[flask_mail.Connection] = None
+
+    def __enter__(self) -> 'BatchMailer':
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        self.close()
+
+    def connect(self) -> flask_mail.Connection:
+        if self.connection is None:
+            self.connection = self.mail.connect().__enter__()
+        return self.connection
+
+    def close(self) -> None:
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass  # Already gone
+
+    def send(self, msg: flask_mail.Message) -> None:
+        try:
+            self.connect().send(msg)
+        except OSError as e:
+            if not connection_lost(e):
+                raise  # Rejected, sending it again would only duplicate it or fail the same way
+            self.close()
+            self.connect().send(msg)
+
+    def send_all(self, messages: List[flask_mail.Message], on_done: Optional[Callable[[int], None]] = None) -> int:
+        """Sends every message, skipping (and logging) those the server rejects
+
+        `on_done` is called with the index of each message once it has been sent or rejected.
+        Raises MailServerUnavailable if the server can't be reached, recording how far it got.
+        """
+        sent = 0
+        for index, msg in enumerate(messages):
+            try:
+                self.send(msg)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                flask.current_app.logger.warning("Email to %s rejected: %s", msg.recipients, e)
+            except (smtplib.SMTPException, OSError) as e:
+                raise MailServerUnavailable(index) from e
+            else:
+                sent += 1
+            if on_done is not None:
+                on_done(index)
+        return sent
+
+
+def connection_lost(error: OSError) -> bool:
+    """SMTPException subclasses OSError, so tell server responses apart from dropped connections"""
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    return not isinstance(error, smtplib.SMTPException)
+
+
+class MailServerUnavailable(Exception):
+    def __init__(self, attempted: int):
+        super().__init__(f"Mail server unavailable after {attempted} emails")
+        self.attempted = attempted
+
+
+def queue_emails(messages: List[flask_mail.Message]) -> None:
+    """Hands emails to the mail worker, or to an RQ job if the outbox is disabled"""
+    if len(messages) == 0:
+        return
+    if flask.current_app.config['MAIL_OUTBOX_ENABLED']:
+        redis_store.lpush(OUTBOX_KEY, *(pickle.dumps(msg) for msg in messages))  # Taken from the other end
+    else:
+        from .tasks import send_emails
+        send_emails.queue(messages)
+
+
+def next_batch(batch_size: int, flush_interval: float) -> List[bytes]:
+    """Waits for the first queued email, then collects more until the batch is full or the interval passes
+
+    Each email is moved onto the processing list as it is taken, so none are lost if the worker dies
+    before sending them, see `recover`.
+    """
+    batch = []
+    deadline = time.monotonic() + flush_interval
+    while len(batch) < batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        item = redis_store.brpoplpush(OUTBOX_KEY, PROCESSING_KEY, timeout=max(1, int(remaining)))
+        if item is None:
+            break
+        batch.append(item)
+
+        # Take whatever else is already waiting in one round trip
+        pipeline = redis_store.pipeline()
+        for _ in range(batch_size - len(batch)):
+            pipeline.rpoplpush(OUTBOX_KEY, PROCESSING_KEY)
+        batch.extend(item for item in pipeline.execute() if item is not None)
+    return batch
+
+
+def requeue(batch: List[bytes]) -> None:
+    """Moves emails from the processing list back to the outbox, to be taken again first"""
+    if len(batch) == 0:
+        return
+    pipeline = redis_store.pipeline()
+    for item in batch:
+        pipeline.lrem(PROCESSING_KEY, 1, item)
+    pipeline.rpush(OUTBOX_KEY, *reversed(batch))
+    pipeline.execute()
+
+
+def recover() -> int:
+    """Requeues the emails a previous worker took but didn't finish, returning how many there were
+
+    Only safe while no other worker is running.
+    """
+    batch = redis_store.lrange(PROCESSING_KEY, 0, -1)
+    requeue(batch[::-1])  # Oldest first
+    return len(batch)
+
+
+def send_batch(mailer: BatchMailer, batch: List[bytes]) -> bool:
+    """Sends a batch from `next_batch`, removing each email from the processing list once it's done with
+
+    Returns False if sending stopped part way, after requeueing the emails which weren't sent.
+    """
+    done = []
+
+    def acknowledge(index: int) -> None:
+        redis_store.lrem(PROCESSING_KEY, 1, batch[index])
+        done.append(index)
+
+    try:
+        sent = mailer.send_all([pickle.loads(item) for item in batch], acknowledge)
+    except Exception:
+        unsent = batch[len(done):]
+        flask.current_app.logger.exception("Requeueing %d emails", len(unsent))
+        requeue(unsent)
+        return False
+    flask.current_app.logger.info("Sent %d of %d emails", sent, len(batch))
+    return True
+
+
+def run_worker(batch_size: int, flush_interval: float) -> None:
+    """Drains the outbox forever, keeping the SMTP connection open while there is mail to send
+
+    Run one worker at a time, it starts by requeueing whatever the last one left unsent.
+    """
+    recovered = recover()
+    if recovered > 0:
+        flask.current_app.logger.warning("Requeued %d emails left by a stopped worker", recovered)
+    with BatchMailer() as mailer:
+        while True:
+            batch = next_batch(batch_size, flush_interval)
+            if len(batch) == 0:
+                mailer.close()  # Idle, don't hold the connection open
+                continue
+            if not send_batch(mailer, batch):
+                mailer.close()
+                time.sleep(flush_interval)
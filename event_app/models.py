@@ -2,21 +2,25 @@
 import enum
 import math
 import os
+import pickle
 import uuid
 from datetime import datetime
 from decimal import Decimal
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
 
 import flask
-import hashids
 from bcrypt import gensalt
 from flask_login import UserMixin
-from sqlalchemy import func
+from sqlalchemy import and_, bindparam, event as sqlalchemy_event, func, inspect as sqlalchemy_inspect
 from sqlalchemy.dialects.mysql import DECIMAL, JSON
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
+from sqlalchemy.orm import make_transient_to_detached, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 
-from .extensions import bcrypt, db
+from .extensions import db, password_hasher, redis_store, url_tokens
+from .geo import EARTH_RADIUS
 
 Model = db.Model
 Column = db.Column
@@ -104,7 +108,7 @@ class User(CommonMixin, UserMixin, Model):
         And the password will be converted and saved appropriately.
         """
         salted_password = plain_password + self.salt.decode()
-        self._password = bcrypt.generate_password_hash(salted_password)
+        self._password = password_hasher.hash(salted_password)
 
     @hybrid_property
     def location_enabled(self) -> bool:
@@ -116,9 +120,16 @@ class User(CommonMixin, UserMixin, Model):
         return (self.latitude != None) & (self.longitude != None)
 
     def check_password(self, plain_password: str) -> bool:
-        """Checks If The User Entered The Right Password"""
+        """Checks If The User Entered The Right Password
+
+        Passwords hashed with an outdated work factor are rehashed, the caller commits the change.
+        """
         salted_password = plain_password + self.salt.decode()
-        return bcrypt.check_password_hash(self.password, salted_password)
+        if not password_hasher.check(salted_password, self.password):
+            return False
+        if password_hasher.needs_rehash(self.password):
+            self.password = plain_password
+        return True
 
     def subscribed(self, event: "Event") -> bool:
         return db.session.query(
@@ -137,6 +148,94 @@ class User(CommonMixin, UserMixin, Model):
         """Returns a salt which will be stored"""
         return gensalt()
 
+    # flask_login loads the user on every request, so a snapshot of the user's columns is cached in redis.
+    # Password fields are left out and load from the database if they're ever needed.
+
+    SNAPSHOT_EXCLUDE = {'salt', '_password'}
+
+    @staticmethod
+    def snapshot_key(session_token: str) -> str:
+        return 'USER:SNAPSHOT#{}'.format(session_token)
+
+    @staticmethod
+    def load_by_session_token(session_token: str) -> Optional['User']:
+        snapshot: Optional[bytes] = redis_store.get(User.snapshot_key(session_token))
+        if snapshot is not None:
+            return User.from_snapshot(pickle.loads(snapshot))
+        user = User.query.filter_by(session_token=session_token).first()
+        if user is not None:
+            redis_store.set(User.snapshot_key(session_token), pickle.dumps(user.snapshot()),
+                            ex=flask.current_app.config['USER_SNAPSHOT_TTL'])
+        return user
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {attr.key: getattr(self, attr.key) for attr in User.__mapper__.column_attrs
+                if attr.key not in User.SNAPSHOT_EXCLUDE}
+
+    @staticmethod
+    def from_snapshot(snapshot: Dict[str, Any]) -> 'User':
+        """Attaches a user to the session from a snapshot without querying"""
+        user = User.__mapper__.class_manager.new_instance()
+        for key, value in snapshot.items():
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+
+# Snapshots are dropped once the change commits. Dropping them at flush would let another request cache the old row
+# again before the commit, such as a session token that was just rotated.
+
+@sqlalchemy_event.listens_for(User, 'after_update')
+@sqlalchemy_event.listens_for(User, 'after_delete')
+def mark_user_snapshot_stale(mapper, connection, user: User) -> None:
+    tokens = set(sqlalchemy_inspect(user).attrs.session_token.history.sum()) | {user.session_token}
+    object_session(user).info.setdefault('stale_user_snapshots', set()).update(
+            token for token in tokens if token is not None
+    )
+
+
+@sqlalchemy_event.listens_for(db.session, 'after_commit')
+def invalidate_user_snapshots(session) -> None:
+    tokens = session.info.pop('stale_user_snapshots', set())
+    if len(tokens) > 0:
+        redis_store.delete(*(User.snapshot_key(token) for token in tokens))
+
+
+@sqlalchemy_event.listens_for(db.session, 'after_rollback')
+def forget_stale_user_snapshots(session) -> None:
+    session.info.pop('stale_user_snapshots', None)
+
+
+def bounding_box(latitude: Decimal, longitude: Decimal,
+                 distance: float) -> Tuple[float, float, Optional[float], Optional[float]]:
+    """Returns the (min_lat, max_lat, min_lng, max_lng) box enclosing a circle of `distance` Km
+
+    The longitude bounds are None if the circle covers a pole or crosses the antimeridian,
+    as no single longitude range can describe it.
+    """
+    angular_distance = distance / EARTH_RADIUS
+    lat = math.radians(latitude)
+    lng = math.radians(longitude)
+    min_lat = lat - angular_distance
+    max_lat = lat + angular_distance
+
+    if min_lat > -math.pi / 2 and max_lat < math.pi / 2:
+        delta_lng = math.asin(math.sin(angular_distance) / math.cos(lat))
+        min_lng = lng - delta_lng
+        max_lng = lng + delta_lng
+        if min_lng < -math.pi or max_lng > math.pi:
+            return math.degrees(min_lat), math.degrees(max_lat), None, None
+        return math.degrees(min_lat), math.degrees(max_lat), math.degrees(min_lng), math.degrees(max_lng)
+    else:
+        return max(math.degrees(min_lat), -90), min(math.degrees(max_lat), 90), None, None
+
+
+class EventRef(NamedTuple):
+    """The parts of an event needed for permission checks"""
+    id: int
+    owner_id: int
+    private: bool
+
 
 class Event(CommonMixin, Model):
     id: int = Column(db.Integer, primary_key=True)
@@ -145,7 +244,8 @@ class Event(CommonMixin, Model):
     subscriptions: List["Subscription"] = relationship("Subscription", back_populates="event")
 
     name: str = Column(db.String(100), nullable=False)
-    description: str = Column(db.Text, nullable=True)
+    description: str = Column(db.Text, nullable=True)  # Sanitised HTML
+    description_source: str = Column(db.Text, nullable=True)  # Markdown
     start: datetime = Column(db.DateTime, nullable=False, default=None)
     latitude: Decimal = Column(DECIMAL(precision=7, scale=5, unsigned=False), nullable=True)  # -90 < latitude < 90
     longitude: Decimal = Column(DECIMAL(precision=8, scale=5, unsigned=False), nullable=True)  # -180  < longitude < 180
@@ -153,6 +253,12 @@ class Event(CommonMixin, Model):
 
     created_at: datetime = Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_event_location', 'latitude', 'longitude'),
+        db.Index('ix_event_private_start', 'private', 'start'),
+        db.Index('ix_event_private_name', 'private', 'name'),
+    )
+
     @hybrid_property
     def location_enabled(self) -> bool:
         return (self.latitude is not None) and (self.longitude is not None)
@@ -162,6 +268,23 @@ class Event(CommonMixin, Model):
     def location_enabled(self) -> bool:
         return (self.latitude != None) & (self.longitude != None)
 
+    @hybrid_method
+    def within_distance(self, latitude: Decimal, longitude: Decimal, distance: float) -> bool:
+        return self.location_enabled and self.distance_from(latitude, longitude) <= distance
+
+    @within_distance.expression
+    def within_distance(self, latitude: Decimal, longitude: Decimal, distance: float):
+        """Prefilters on the indexed location columns
+
+        The bounding box lets the database range scan `ix_event_location`,
+        so the great-circle distance is only evaluated for candidate rows.
+        """
+        min_lat, max_lat, min_lng, max_lng = bounding_box(latitude, longitude, distance)
+        clause = self.latitude.between(min_lat, max_lat)
+        if min_lng is not None:
+            clause &= self.longitude.between(min_lng, max_lng)
+        return clause & (self.distance_from(latitude, longitude) <= distance)
+
     @hybrid_method
     def distance_from(self, latitude: Decimal, longitude: Decimal) -> float:
         return math.acos(
@@ -170,7 +293,7 @@ class Event(CommonMixin, Model):
                 * math.cos(math.radians(self.longitude) - math.radians(longitude))
                 + math.sin(math.radians(self.latitude))
                 * math.sin(math.radians(latitude))
-        ) * 6371
+        ) * EARTH_RADIUS
 
     @distance_from.expression
     def distance_from(self, latitude: Decimal, longitude: Decimal) -> float:
@@ -180,18 +303,58 @@ class Event(CommonMixin, Model):
                 * func.cos(func.radians(self.longitude) - func.radians(longitude))
                 + func.sin(func.radians(self.latitude))
                 * func.sin(func.radians(latitude))
-        ) * 6371
+        ) * EARTH_RADIUS
 
     @property
     def url_id(self) -> str:
-        encoder = hashids.Hashids(min_length=10, salt=flask.current_app.config["HASHID_SALT"])
-        return encoder.encode(self.id)
+        return url_tokens.encode(self.id)
+
+    @staticmethod
+    def fetch_from_url_token(token: str) -> Optional['Event']:
+        id_ = url_tokens.decode(token)
+        return None if id_ is None else Event.query.get(id_)
+
+    @staticmethod
+    def ref_from_url_token(token: str) -> Optional[EventRef]:
+        id_ = url_tokens.decode(token)
+        return None if id_ is None else Event.ref(id_)
+
+    @staticmethod
+    def ref(id_: int) -> Optional[EventRef]:
+        """Resolves an event id for permission checks without loading the event
+
+        Looked up in this request, the session's identity map, redis and finally the database.
+        An event's owner and privacy never change, so cached refs don't need invalidating.
+        """
+        refs: Dict[int, EventRef] = flask.g.setdefault('event_refs', {})
+        ref = refs.get(id_)
+        if ref is None:
+            ref = Event._load_ref(id_)
+            if ref is not None:
+                refs[id_] = ref
+        return ref
 
     @staticmethod
-    def fetch_from_url_token(token: str) -> 'Event':
-        decoder = hashids.Hashids(min_length=10, salt=flask.current_app.config["HASHID_SALT"])
-        id = decoder.decode(token)
-        return Event.query.get(id)
+    def ref_key(id_: int) -> str:
+        return 'EVENT:REF#{}'.format(id_)
+
+    @staticmethod
+    def _load_ref(id_: int) -> Optional[EventRef]:
+        event: Optional[Event] = db.session.identity_map.get(identity_key(Event, id_))
+        if event is not None and 'owner_id' in vars(event):  # Loaded and not expired
+            return EventRef(event.id, event.owner_id, event.private)
+
+        cached: Optional[bytes] = redis_store.get(Event.ref_key(id_))
+        if cached is not None:
+            owner_id, private = cached.decode().split(':')
+            return EventRef(id_, int(owner_id), private == '1')
+
+        row = db.session.query(Event.owner_id, Event.private).filter(Event.id == id_).first()
+        if row is None:
+            return None
+        redis_store.set(Event.ref_key(id_), '{}:{:d}'.format(row.owner_id, row.private),
+                        ex=flask.current_app.config['EVENT_REF_TTL'])
+        return EventRef(id_, row.owner_id, row.private)
 
 
 class Subscription(CommonMixin, Model):
@@ -203,8 +366,131 @@ class Subscription(CommonMixin, Model):
     last_viewed: datetime = Column(db.DateTime, default=datetime.utcnow)
 
     def update(self):
-        self.last_viewed = datetime.utcnow()
-        db.session.commit()
+        self.mark_viewed(self.user_id, self.event_id)
+
+    # Last viewed times are buffered in redis as one hash per user: {event_id: timestamp}
+    # They are written to the database in batches by `tasks.flush_last_viewed`, so read them through
+    # `last_viewed_buffer` first. Users with buffered times are kept in a set.
+
+    LAST_VIEWED_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+    LAST_VIEWED_USERS_KEY = 'SUBSCRIPTION:LAST_VIEWED_USERS'
+
+    # Drops the buffered times that were flushed, unless they changed in the meantime
+    # KEYS: the user's buffer, the set of users; ARGV: user id, then event id and timestamp pairs
+    DISCARD_FLUSHED_SCRIPT = """
+        for i = 2, #ARGV, 2 do
+            if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+                redis.call('HDEL', KEYS[1], ARGV[i])
+            end
+        end
+        if redis.call('HLEN', KEYS[1]) == 0 then
+            redis.call('SREM', KEYS[2], ARGV[1])
+        end
+    """
+
+    @staticmethod
+    def last_viewed_key(user_id: int) -> str:
+        return 'USER:LAST_VIEWED#{}'.format(user_id)
+
+    @staticmethod
+    def mark_viewed(user_id: int, event_id: int) -> None:
+        pipeline = redis_store.pipeline()
+        pipeline.hset(Subscription.last_viewed_key(user_id), event_id,
+                      datetime.utcnow().strftime(Subscription.LAST_VIEWED_FORMAT))
+        pipeline.sadd(Subscription.LAST_VIEWED_USERS_KEY, user_id)
+        pipeline.hdel(Subscription.unread_counter_key(user_id), event_id)
+        pipeline.execute()
+
+    @staticmethod
+    def last_viewed_buffer(user_id: int) -> Dict[int, datetime]:
+        """Last viewed times that haven't been written to the database yet"""
+        return {int(event_id): datetime.strptime(timestamp.decode(), Subscription.LAST_VIEWED_FORMAT)
+                for event_id, timestamp in redis_store.hgetall(Subscription.last_viewed_key(user_id)).items()}
+
+    @staticmethod
+    def flush_last_viewed(batch_size: Optional[int] = None) -> int:
+        """Writes buffered last viewed times to the database, returns how many were written"""
+        if batch_size is None:
+            batch_size = flask.current_app.config['LAST_VIEWED_FLUSH_BATCH_SIZE']
+        table = Subscription.__table__
+        statement = table.update().where(and_(
+                table.c.user_id == bindparam('b_user_id'),
+                table.c.event_id == bindparam('b_event_id')
+        )).values(last_viewed=bindparam('b_last_viewed'))
+        discard_flushed = redis_store.register_script(Subscription.DISCARD_FLUSHED_SCRIPT)
+
+        user_ids = [int(user_id) for user_id in redis_store.smembers(Subscription.LAST_VIEWED_USERS_KEY)]
+        flushed = 0
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            pipeline = redis_store.pipeline(transaction=False)
+            for user_id in batch:
+                pipeline.hgetall(Subscription.last_viewed_key(user_id))
+            buffers = dict(zip(batch, pipeline.execute()))
+
+            rows = [{
+                "b_user_id": user_id,
+                "b_event_id": int(event_id),
+                "b_last_viewed": datetime.strptime(timestamp.decode(), Subscription.LAST_VIEWED_FORMAT)
+            } for user_id, buffer in buffers.items() for event_id, timestamp in buffer.items()]
+            if len(rows) > 0:
+                db.session.execute(statement, rows)
+                db.session.commit()
+
+            pipeline = redis_store.pipeline(transaction=False)
+            for user_id, buffer in buffers.items():
+                discard_flushed(keys=[Subscription.last_viewed_key(user_id), Subscription.LAST_VIEWED_USERS_KEY],
+                                args=[user_id, *(item for pair in buffer.items() for item in pair)], client=pipeline)
+            pipeline.execute()
+            flushed += len(rows)
+        return flushed
+
+    # Unread message counters are materialised in redis as one hash per user: {event_id: count}
+    # They can be rebuilt from the database with `flask rebuild_unread_counters`
+
+    @staticmethod
+    def unread_counter_key(user_id: int) -> str:
+        return 'USER:UNREAD_MESSAGES#{}'.format(user_id)
+
+    @staticmethod
+    def reset_unread_count(user_id: int, event_id: int) -> None:
+        redis_store.hdel(Subscription.unread_counter_key(user_id), event_id)
+
+    # Adjusts the counters of subscribers whose buffered last viewed time, if any, is before the message.
+    # Checked in the script so a view can't land between the check and the adjustment.
+    # KEYS: each subscriber's last viewed buffer and unread counter in turn; ARGV: event id, message timestamp, amount
+    COUNT_UNREAD_SCRIPT = """
+        for i = 1, #KEYS, 2 do
+            local viewed = redis.call('HGET', KEYS[i], ARGV[1])
+            if not viewed or viewed < ARGV[2] then
+                redis.call('HINCRBY', KEYS[i + 1], ARGV[1], ARGV[3])
+            end
+        end
+    """
+    COUNT_UNREAD_BATCH_SIZE = 500  # Subscribers per script call
+
+    @staticmethod
+    def count_unread_message(message: 'EventMessage', amount: int = 1) -> None:
+        """Adjusts the counters of every subscriber who hasn't viewed the event since the message"""
+        subscribers = [user_id for user_id, in db.session.query(Subscription.user_id).filter(
+                Subscription.event_id == message.event_id,
+                Subscription.last_viewed < message.timestamp
+        )]
+        count_unread = redis_store.register_script(Subscription.COUNT_UNREAD_SCRIPT)
+        timestamp = message.timestamp.strftime(Subscription.LAST_VIEWED_FORMAT)
+        pipeline = redis_store.pipeline(transaction=False)
+        for start in range(0, len(subscribers), Subscription.COUNT_UNREAD_BATCH_SIZE):
+            keys = [key for user_id in subscribers[start:start + Subscription.COUNT_UNREAD_BATCH_SIZE]
+                    for key in (Subscription.last_viewed_key(user_id), Subscription.unread_counter_key(user_id))]
+            count_unread(keys=keys, args=[message.event_id, timestamp, amount], client=pipeline)
+        pipeline.execute()
+
+    @staticmethod
+    def unread_counts(user_id: int, event_ids: List[int]) -> Dict[int, int]:
+        if len(event_ids) == 0:
+            return {}
+        counts = redis_store.hmget(Subscription.unread_counter_key(user_id), event_ids)
+        return {event_id: max(int(count or 0), 0) for event_id, count in zip(event_ids, counts)}
 
 
 class WebPushToken(CommonMixin, Model):
@@ -216,6 +502,11 @@ class WebPushToken(CommonMixin, Model):
     auth: str = Column(db.String(30), nullable=False)
 
 
+def image_filename(digest: str, width: int, extension: str) -> str:
+    """Uploaded images are stored by the hash of their content, see `utils.save_image`"""
+    return f"{digest}-{width}.{extension}"
+
+
 class EventMessage(CommonMixin, Model):
     id: int = Column(db.Integer, primary_key=True)
     event_id: int = Column(db.Integer, ForeignKey('event.id'))
@@ -225,6 +516,10 @@ class EventMessage(CommonMixin, Model):
     type: MessageTypes = Column(db.Enum(MessageTypes))
     data: Dict[str, Any] = Column(JSON)
 
+    __table_args__ = (
+        db.Index('ix_eventmessage_event_timestamp', 'event_id', 'timestamp'),
+    )
+
     def render(self) -> str:
         """Renders the message for display"""
 
@@ -232,8 +527,25 @@ class EventMessage(CommonMixin, Model):
             data = self.data['message']
             return data
         elif self.type is MessageTypes.IMAGE:
-            file = os.path.join(flask.current_app.config['UPLOAD_FOLDER'], self.data['file'])
-            return f"<img src='{flask.url_for('static', filename=file, _external=True, _scheme='https')}'>"
+            if 'widths' not in self.data:  # Uploaded before responsive images
+                return f"<img src='{self.image_url(self.data['file'])}'>"
+            widths = self.data['widths']
+            srcset = {
+                extension: ", ".join(
+                        f"{self.image_url(image_filename(self.data['hash'], width, extension))} {width}w"
+                        for width in widths
+                ) for extension in ("webp", "jpeg")
+            }
+            sizes = f"(max-width: {widths[-1]}px) 100vw, {widths[-1]}px"
+            return (f"<picture>"
+                    f"<source type='image/webp' srcset='{srcset['webp']}' sizes='{sizes}'>"
+                    f"<img src='{self.image_url(self.data['file'])}' srcset='{srcset['jpeg']}' sizes='{sizes}'>"
+                    f"</picture>")
+
+    @staticmethod
+    def image_url(filename: str) -> str:
+        file = os.path.join(flask.current_app.config['UPLOAD_FOLDER'], filename)
+        return flask.url_for('static', filename=file, _external=True, _scheme='https')
 
 
 class Answer(CommonMixin, Model):
@@ -0,0 +1,103 @@
+# coding=utf-8
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+import flask
+import requests
+from py_vapid import Vapid
+from pywebpush import WebPusher
+from requests.adapters import HTTPAdapter
+
+SubscriptionInfo = Dict[str, Union[str, Dict[str, str]]]
+
+
+class PushSender:
+    """Delivers web push notifications
+
+    Keeps a pooled HTTP session per push service origin, parses the VAPID key once,
+    and reuses the signed VAPID headers for an origin until shortly before they expire.
+    """
+
+    CLAIMS_LIFETIME = 12 * 60 * 60  # Seconds, the longest push services accept
+    CLAIMS_MARGIN = 60 * 60  # Seconds, re-sign this long before expiry
+
+    def __init__(self, app: Optional[flask.Flask] = None):
+        self.private_key: Optional[str] = None
+        self.subject: Optional[str] = None
+        self.concurrency = 1
+        self.timeout: Optional[float] = None
+        self._vapid: Optional[Vapid] = None
+        self._sessions: Dict[str, requests.Session] = {}
+        self._headers: Dict[str, Tuple[float, Dict[str, str]]] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: flask.Flask) -> None:
+        self.private_key = app.config.get('WEB_PUSH_PRIVATE_KEY')
+        self.subject = app.config['WEB_PUSH_SUBJECT']
+        self.concurrency = app.config['WEB_PUSH_CONCURRENCY']
+        self.timeout = app.config['WEB_PUSH_TIMEOUT']
+        app.extensions['push_sender'] = self
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+            return self._executor
+
+    def session(self, origin: str) -> requests.Session:
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                session.mount(origin, HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency))
+                self._sessions[origin] = session
+            return session
+
+    def vapid_headers(self, origin: str) -> Dict[str, str]:
+        now = time.time()
+        with self._lock:
+            cached = self._headers.get(origin)
+            if cached is not None and cached[0] - self.CLAIMS_MARGIN > now:
+                return dict(cached[1])
+            if self._vapid is None:
+                self._vapid = Vapid.from_string(private_key=self.private_key)
+            expires = int(now) + self.CLAIMS_LIFETIME
+            headers = self._vapid.sign({"sub": self.subject, "aud": origin, "exp": expires})
+            self._headers[origin] = (expires, headers)
+            return dict(headers)
+
+    def send(self, subscription_info: SubscriptionInfo, data: str) -> requests.Response:
+        url = urlparse(subscription_info['endpoint'])
+        origin = f"{url.scheme}://{url.netloc}"
+        pusher = WebPusher(subscription_info, requests_session=self.session(origin))
+        return pusher.send(data, headers=self.vapid_headers(origin), timeout=self.timeout)
+
+    def send_batch(self, subscriptions: List[SubscriptionInfo], data: Union[dict, list]) -> List[str]:
+        """Sends the same payload to every subscription concurrently
+
+        Returns the endpoints which the push service reported as expired.
+        """
+        payload = json.dumps(data)
+        futures = [(info['endpoint'], self.executor.submit(self.send, info, payload)) for info in subscriptions]
+
+        expired = []
+        for endpoint, future in futures:
+            try:
+                response = future.result()
+            except Exception as e:  # Bad keys or a failed request only lose this subscription's push
+                flask.current_app.logger.warning("Push to %s failed: %r", endpoint, e)
+                continue
+            if response.status_code in (404, 410):
+                expired.append(endpoint)
+            elif response.status_code >= 300:
+                flask.current_app.logger.warning("Push to %s rejected: %d %s", endpoint, response.status_code,
+                                                 response.text)
+        return expired
@@ -0,0 +1,104 @@
+# coding=utf-8
+"""Markdown rendering for event descriptions and text messages
+
+The markdown source is stored alongside the sanitised HTML, so everything can be re-rendered
+with `flask rerender_markdown` when the whitelist changes. Rendered HTML is cached by the hash
+of its source and of the whitelist.
+"""
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+import bleach
+import flask
+from markdown import Markdown
+from mdx_downheader import DownHeaderExtension
+
+from . import models
+from .cache import LRUCache
+from .extensions import cleaner, db, redis_store
+
+WHITELIST_VERSION = hashlib.sha256(
+        repr((sorted(cleaner.tags), cleaner.attributes, sorted(cleaner.protocols), cleaner.strip,
+              cleaner.strip_comments)).encode()
+).hexdigest()[:8]
+
+_local = threading.local()  # Neither Markdown nor Cleaner instances are thread safe
+_rendered = LRUCache(maxsize=1024)
+
+
+def _renderer() -> Tuple[Markdown, bleach.sanitizer.Cleaner]:
+    if not hasattr(_local, 'markdown'):
+        _local.markdown = Markdown(extensions=[DownHeaderExtension(levels=3)])
+        _local.cleaner = bleach.sanitizer.Cleaner(tags=cleaner.tags, attributes=cleaner.attributes,
+                                                  protocols=cleaner.protocols, strip=cleaner.strip,
+                                                  strip_comments=cleaner.strip_comments)
+    return _local.markdown, _local.cleaner
+
+
+def render_uncached(source: str) -> str:
+    markdown, sanitiser = _renderer()
+    try:
+        return sanitiser.clean(markdown.convert(source))
+    finally:
+        markdown.reset()
+
+
+def cache_key(source: str) -> str:
+    return 'MARKDOWN:HTML#{}:{}'.format(WHITELIST_VERSION, hashlib.sha256(source.encode()).hexdigest())
+
+
+def render(source: str) -> str:
+    """Renders and sanitises markdown, reusing the HTML if the same source has been rendered before"""
+    key = cache_key(source)
+    html = _rendered.get(key)
+    if html is None:
+        cached: Optional[bytes] = redis_store.get(key)
+        if cached is not None:
+            html = cached.decode()
+        else:
+            html = render_uncached(source)
+            redis_store.set(key, html, ex=flask.current_app.config['MARKDOWN_CACHE_TTL'])
+        _rendered.set(key, html)
+    return html
+
+
+def rerender_all(workers: Optional[int] = None, batch_size: int = 500) -> int:
+    """Re-renders every stored description and text message from its source across a process pool
+
+    Rows saved before sources were kept are left as they are. Returns the number of rows updated.
+    """
+    updated = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        last_id = 0
+        while True:
+            events = models.Event.query.filter(
+                    models.Event.id > last_id,
+                    models.Event.description_source != None  # noqa: E711
+            ).order_by(models.Event.id).limit(batch_size).all()
+            if len(events) == 0:
+                break
+            sources = [event.description_source for event in events]
+            for event, html in zip(events, pool.map(render_uncached, sources, chunksize=32)):
+                event.description = html
+            db.session.commit()
+            updated += len(events)
+            last_id = events[-1].id
+
+        last_id = 0
+        while True:
+            messages = models.EventMessage.query.filter(
+                    models.EventMessage.id > last_id,
+                    models.EventMessage.type == models.MessageTypes.TEXT
+            ).order_by(models.EventMessage.id).limit(batch_size).all()
+            if len(messages) == 0:
+                break
+            last_id = messages[-1].id
+            messages = [message for message in messages if 'source' in message.data]
+            sources = [message.data['source'] for message in messages]
+            for message, html in zip(messages, pool.map(render_uncached, sources, chunksize=32)):
+                message.data = dict(message.data, message=html)  # Reassigned so the JSON change is tracked
+            db.session.commit()
+            updated += len(messages)
+    return updated
@@ -0,0 +1,204 @@
+# coding=utf-8
+"""Asynchronous server sent events
+
+Serves the same stream as the `sse` blueprint (same channels, same authorisation)
+without tying up a gunicorn worker per open tab. Each process holds a single redis
+connection, subscribed to the union of its clients' channels, and fans messages out
+to the connected clients in memory. A subscribed connection can't run other commands,
+so replays go through a separate small pool.
+
+Run with `flask run_sse_server` and route /stream to it.
+"""
+import asyncio
+import json
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import aioredis
+import flask
+from aiohttp import web
+from aioredis.pubsub import Receiver
+from flask.sessions import SecureCookieSessionInterface
+from flask_sse import Message
+from itsdangerous import BadSignature
+
+from . import models
+from .extensions import db
+from .views.sse import get_channel, get_replay_key, parse_last_event_id, subscribed_topics
+
+HEARTBEAT = b": heartbeat\n\n"
+
+
+class Client:
+    """A connected browser tab"""
+
+    def __init__(self, channels: List[str], queue_size: int):
+        self.channels = channels
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+    def offer(self, message_id: Optional[int], data: bytes) -> None:
+        """Queues an event, marking the client as too slow to keep up if its queue is full"""
+        try:
+            self.queue.put_nowait((message_id, data))
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class StreamServer:
+    def __init__(self, app: flask.Flask):
+        self.app = app
+        self.heartbeat_interval = app.config['SSE_HEARTBEAT_INTERVAL']
+        self.queue_size = app.config['SSE_CLIENT_QUEUE_SIZE']
+        self.session_serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+        self.redis: Optional[aioredis.Redis] = None  # Subscriptions only
+        self.pool: Optional[aioredis.Redis] = None  # Everything else
+        self.receiver = Receiver()
+        self.clients: Dict[str, Set[Client]] = defaultdict(set)
+        self.connections = 0
+
+    def make_app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_get('/stream', self.handle_stream)
+        application.router.add_get('/stream/stats', self.handle_stats)
+        application.on_startup.append(self.on_startup)
+        application.on_cleanup.append(self.on_cleanup)
+        return application
+
+    async def on_startup(self, application: web.Application) -> None:
+        self.redis = await aioredis.create_redis(self.app.config['REDIS_URL'])
+        self.pool = await aioredis.create_redis_pool(self.app.config['REDIS_URL'])
+        application['dispatcher'] = asyncio.ensure_future(self.dispatch())
+
+    async def on_cleanup(self, application: web.Application) -> None:
+        application['dispatcher'].cancel()
+        self.receiver.stop()
+        for connection in (self.redis, self.pool):
+            connection.close()
+            await connection.wait_closed()
+
+    async def dispatch(self) -> None:
+        """Forwards every message from the shared subscription to the clients listening for it"""
+        async for channel, payload in self.receiver.iter():
+            message = self.parse(payload)
+            if message is None:
+                continue
+            data = str(message).encode()
+            for client in tuple(self.clients.get(channel.name.decode(), ())):
+                client.offer(message.id, data)
+
+    def parse(self, payload: bytes) -> Optional[Message]:
+        """Decodes a published event, logging and skipping a malformed one rather than ending every stream"""
+        try:
+            return Message(**json.loads(payload))
+        except (TypeError, ValueError) as e:
+            self.app.logger.warning("Skipping malformed event %r: %s", payload, e)
+            return None
+
+    async def replay(self, channels: List[str], last_event_id: int) -> List[Message]:
+        """Messages published to any of `channels` after `last_event_id`, oldest first"""
+        results = await asyncio.gather(*(
+            self.pool.zrangebyscore(get_replay_key(channel), min=last_event_id, exclude=self.pool.ZSET_EXCLUDE_MIN)
+            for channel in channels
+        ))
+        messages = [message for message in (self.parse(data) for result in results for data in result)
+                    if message is not None]
+        return sorted(messages, key=lambda message: message.id)
+
+    async def subscribe(self, client: Client) -> None:
+        new_channels = [channel for channel in client.channels if channel not in self.clients]
+        for channel in client.channels:
+            self.clients[channel].add(client)
+        if len(new_channels) > 0:
+            await self.redis.subscribe(*(self.receiver.channel(channel) for channel in new_channels))
+
+    async def unsubscribe(self, client: Client) -> None:
+        unused_channels = []
+        for channel in client.channels:
+            listeners = self.clients.get(channel)
+            if listeners is not None:
+                listeners.discard(client)
+                if len(listeners) == 0:
+                    del self.clients[channel]
+                    unused_channels.append(channel)
+        if len(unused_channels) > 0:
+            await self.redis.unsubscribe(*unused_channels)
+
+    def authorise(self, session_cookie: Optional[str], requested_channel: str) -> Optional[List[str]]:
+        """Resolves the channels a request may stream, or None if it may not
+
+        Blocking, so run it in an executor.
+        """
+        if session_cookie is None:
+            return None
+        try:
+            session = self.session_serializer.loads(
+                    session_cookie, max_age=self.app.permanent_session_lifetime.total_seconds()
+            )
+        except BadSignature:
+            return None
+        token = session.get('user_id')
+        if token is None:
+            return None
+
+        with self.app.app_context():
+            try:
+                user = models.User.query.filter_by(session_token=token).first()
+                if user is None or get_channel(user) != requested_channel:
+                    return None
+                return [requested_channel] + subscribed_topics(user)
+            finally:
+                db.session.remove()
+
+    async def handle_stream(self, request: web.Request) -> web.StreamResponse:
+        requested_channel = request.query.get('channel')
+        if requested_channel is None:
+            raise web.HTTPBadRequest()
+        session_cookie = request.cookies.get(self.app.config['SESSION_COOKIE_NAME'])
+        channels = await asyncio.get_event_loop().run_in_executor(
+                None, self.authorise, session_cookie, requested_channel
+        )
+        if channels is None:
+            raise web.HTTPForbidden()
+        last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID'))
+
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        await response.prepare(request)
+
+        client = Client(channels, self.queue_size)
+        self.connections += 1
+        await self.subscribe(client)  # Subscribe before replaying so nothing published in between is lost
+        try:
+            replayed = set()
+            if last_event_id is not None:
+                for message in await self.replay(channels, last_event_id):
+                    replayed.add(message.id)
+                    await response.write(str(message).encode())
+            while not client.overflowed:
+                try:
+                    message_id, data = await asyncio.wait_for(client.queue.get(), timeout=self.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    message_id, data = None, HEARTBEAT
+                if message_id is None or message_id not in replayed:
+                    await response.write(data)
+        except ConnectionResetError:
+            pass  # Client went away
+        finally:
+            self.connections -= 1
+            await self.unsubscribe(client)
+        # An overflowed client is dropped, it will reconnect by itself
+        return response
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "connections": self.connections,
+            "channels": len(self.clients)
+        })
+
+
+def run(app: flask.Flask, host: str, port: int) -> None:
+    web.run_app(StreamServer(app).make_app(), host=host, port=port)
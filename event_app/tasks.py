@@ -1,188 +1,202 @@
 # coding=utf-8
-import json
-from typing import List, Union
+import os
+import time
+from datetime import datetime
+from typing import List, Optional, Union
 
 import flask
 import flask_mail
-import pywebpush
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy.orm import joinedload, selectinload
 
-from . import models
-from .extensions import db, mail, redis_queue
+from . import fragments, models, utils
+from .extensions import db, push_sender, redis_queue
+from .mailer import BatchMailer, queue_emails
 from .models import MessageTypes
-from .views.sse import send_answer, send_message, send_question
+from .views.sse import get_channel, send_answer, send_message, send_question
 
 
 @redis_queue.job
 def send_email(msg: flask_mail.Message):
+    send_emails([msg])
+
+
+@redis_queue.job
+def send_emails(messages: List[flask_mail.Message]):
     with flask.current_app.app_context():
-        mail.send(msg)
+        with BatchMailer() as mailer:
+            mailer.send_all(messages)
 
 
 @redis_queue.job
-def send_push_notification(token: models.WebPushToken, data: Union[dict, list]):
+def send_push_notifications(endpoints: List[str], data: Union[dict, list]):
     with flask.current_app.app_context():
+        tokens = models.WebPushToken.query.filter(models.WebPushToken.endpoint.in_(endpoints)).all()
+        expired = push_sender.send_batch([{
+            "endpoint": token.endpoint,
+            "keys": {
+                "p256dh": token.p256dh,
+                "auth": token.auth
+            }
+        } for token in tokens], data)
+        if len(expired) > 0:
+            flask.current_app.logger.info("Deleting %d Expired Push Tokens", len(expired))
+            models.WebPushToken.query.filter(
+                    models.WebPushToken.endpoint.in_(expired)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+
+
+def push_payload(title: str, body: str, timestamp: datetime, event: models.Event) -> dict:
+    return {
+        "title": title,
+        'options': {
+            "timestamp": timestamp.timestamp(),
+            "tag": "message-group-{}".format(event.url_id),
+            "body": body,
+            "actions": [
+                {
+                    "action": "view-event",
+                    "title": "View Event"
+                }
+            ],
+            "renotify": True,
+            "data": {
+                "url": flask.url_for('events.view_event', token=event.url_id, _external=True, _scheme='https')
+            }
+        }
+    }  # Possible XSS Attack Vector
+
+
+def fan_out(recipients: BaseQuery, event: models.Event, email_subject: str, email_body: str,
+            push_data: dict) -> int:
+    """Queues the email and push notifications for every recipient
+
+    Recipients are loaded a chunk at a time along with their push tokens,
+    and each chunk is handed to a single email job and a single push job.
+    """
+    started = time.perf_counter()
+    html = flask.render_template("email/text_notification.jinja", text=email_body, event=event)
+    chunk_size = flask.current_app.config['NOTIFICATION_CHUNK_SIZE']
+    recipients = recipients.options(selectinload(models.User.webpush_tokens)).order_by(models.User.id)
+
+    count = 0
+    last_id = None
+    while True:
+        query = recipients if last_id is None else recipients.filter(models.User.id > last_id)
+        chunk: List[models.User] = query.limit(chunk_size).all()
+        if len(chunk) == 0:
+            break
+
+        emails = [flask_mail.Message(subject=email_subject, recipients=[user.email], html=html)
+                  for user in chunk if user.email_notify is True]
+        endpoints = [token.endpoint for user in chunk if user.web_push_notify is True
+                     for token in user.webpush_tokens]
+        queue_emails(emails)
+        if len(endpoints) > 0:
+            send_push_notifications.queue(endpoints, push_data)
+
+        count += len(chunk)
+        last_id = chunk[-1].id
+
+    elapsed = time.perf_counter() - started
+    flask.current_app.logger.info("Notified %d recipients in %.3fs (%.0f recipients/s)",
+                                  count, elapsed, count / elapsed if elapsed > 0 else 0)
+    return count
+
+
+def load_notification(kind: str, id_: int) -> Union[models.EventMessage, models.Question, models.Answer]:
+    """Fetches the subject of a notification, and everything needed to send it, in one query"""
+    if kind == "message":
+        return models.EventMessage.query.options(
+                joinedload(models.EventMessage.event)
+        ).filter_by(id=id_).one()
+    elif kind == "question":
+        return models.Question.query.options(
+                joinedload(models.Question.event)
+        ).filter_by(id=id_).one()
+    elif kind == "answer":
+        return models.Answer.query.options(
+                joinedload(models.Answer.question).joinedload(models.Question.event)
+        ).filter_by(id=id_).one()
+    else:
+        raise ValueError(f"Unknown Notification Kind {kind}")
+
+
+@redis_queue.job
+def flush_last_viewed():
+    """Writes the last viewed times buffered by `Subscription.update` to the database"""
+    with flask.current_app.app_context():
+        models.Subscription.flush_last_viewed()
+
+
+@redis_queue.job
+def process_image_message(event_id: int, upload: str, title: Optional[str]):
+    """Resizes a spooled image upload, then posts it as a message and notifies subscribers"""
+    with flask.current_app.app_context():
+        path = utils.spool_path(upload)
         try:
-            pywebpush.webpush(
-                    subscription_info={
-                        "endpoint": token.endpoint,
-                        "keys": {
-                            "p256dh": token.p256dh,
-                            "auth": token.auth
-                        }
-                    },
-                    vapid_private_key=flask.current_app.config['WEB_PUSH_PRIVATE_KEY'],
-                    vapid_claims={
-                        "sub": "mailto:chadfield.jackson@gmail.com"
-                    },
-                    data=json.dumps(data)
-            )
-        except pywebpush.WebPushException as e:
-            if e.response is not None:
-                if e.response.status_code in (404, 410):
-                    print('Expired Token, Deleting...')
-                    db.session.delete(token)
-                    db.session.commit()
-                else:
-                    raise e
-            else:
-                raise e
+            image = utils.save_image(path)
+        finally:
+            os.remove(path)
+
+        message = models.EventMessage(event_id=event_id, type=MessageTypes.IMAGE, data=dict(image, title=title))
+        db.session.add(message)
+        db.session.commit()
+        models.Subscription.count_unread_message(message)
+        fragments.bump_version(event_id)
+
+        # The owner uploaded it but doesn't subscribe to their own event, so they'd never see it arrive
+        owner: models.User = message.event.owner
+        if models.Subscription.query.get((owner.id, event_id)) is None:
+            send_message(message, channel=get_channel(owner))
+        notify.queue("message", message.id)
 
 
-# noinspection PyUnboundLocalVariable
 @redis_queue.job
-def notify(message: Union[models.EventMessage, models.Question, models.Answer],
-           event: models.Event):  # TODO: get rid of event, replace with message.event
+def notify(kind: str, id_: int):
+    """Notifies everyone interested in a new message, question or answer
+
+    Takes ids rather than instances so that jobs stay small and
+    the worker doesn't have to re-attach pickled rows to its session.
+    """
     with flask.current_app.app_context():
-        db.session.add_all([message, event])  # Feels kinda hacky. But It Works So Eh.
+        message = load_notification(kind, id_)
+        event: models.Event = message.question.event if kind == "answer" else message.event
 
         if type(message) is models.EventMessage:
             send_message(message)
-            subscribers: List[models.Subscription] = event.subscriptions
+            recipients = models.User.query.join(
+                    models.Subscription, models.Subscription.user_id == models.User.id
+            ).filter(models.Subscription.event_id == event.id)
 
+            email_subject = "Event Update: {}".format(event.name)
             if message.type is MessageTypes.TEXT:
-                email_subject = "Event Update: {}".format(event.name)
                 email_body = "{} : {}".format(message.data['message'], message.timestamp)
-                push_data = {
-                    "title": event.name,
-                    'options': {
-                        "timestamp": message.timestamp.timestamp(),
-                        "tag": "message-group-{}".format(event.url_id),
-                        "body": message.data.get('title', message.data['message']),
-                        "actions": [
-                            {
-                                "action": "view-event",
-                                "title": "View Event"
-                            }
-                        ],
-                        "renotify": True,
-                        "data": {
-                            "url": flask.url_for('events.view_event', token=event.url_id, _external=True,
-                                                 _scheme='https')
-                        }
-                    },
-                }  # Possible XSS Attack Vector
-
+                push_body = message.data.get('title', message.data['message'])
             elif message.type is MessageTypes.IMAGE:
-                email_subject = "Event Update: {}".format(event.name)
                 email_body = "New Image Message: {}".format(message.timestamp)
-                push_data = {
-                    "title": event.name,
-                    'options': {
-                        "timestamp": message.timestamp.timestamp(),
-                        "tag": "message-group-{}".format(event.url_id),
-                        "body": message.data.get('title', "New Image Message"),
-                        "actions": [
-                            {
-                                "action": "view-event",
-                                "title": "View Event"
-                            }
-                        ],
-                        "renotify": True,
-                        "data": {
-                            "url": flask.url_for('events.view_event', token=event.url_id, _external=True,
-                                                 _scheme='https')
-                        }
-                    },
-                }
-
-            for subscription in subscribers:
-                if subscription.user.email_notify is True:
-                    email_message = flask_mail.Message(subject=email_subject,
-                                                       recipients=[subscription.user.email],
-                                                       html=flask.render_template("email/text_notification.jinja",
-                                                                                  text=email_body,
-                                                                                  event=event))
-                    send_email.queue(email_message)
-                if subscription.user.web_push_notify is True:
-                    for token in subscription.user.webpush_tokens:
-                        send_push_notification.queue(token, push_data)
+                push_body = message.data.get('title', "New Image Message")
+            else:
+                raise ValueError(f"Unknown Message Type {message.type}")
+            push_data = push_payload(event.name, push_body, message.timestamp, event)
 
         elif type(message) is models.Question:
             send_question(message)
+            recipients = models.User.query.filter_by(id=event.owner_id)
             email_subject = "New Question: {}".format(event.name)
             email_body = "{} : {}".format(message.text, message.timestamp)
-            push_data = {
-                "title": 'New Question: {}'.format(event.name),
-                'options': {
-                    "timestamp": message.timestamp.timestamp(),
-                    "tag": "message-group-{}".format(event.url_id),
-                    "body": message.text,
-                    "actions": [
-                        {
-                            "action": "view-event",
-                            "title": "View Event"
-                        }
-                    ],
-                    "renotify": True,
-                    "data": {
-                        "url": flask.url_for('events.view_event', token=event.url_id, _external=True,
-                                             _scheme='https')
-                    }
-                }
-            }  # Possible XSS Attack Vector
-            if event.owner.email_notify is True:
-                email_message = flask_mail.Message(subject=email_subject,
-                                                   recipients=[event.owner.email],
-                                                   html=flask.render_template("email/text_notification.jinja",
-                                                                              text=email_body,
-                                                                              event=event))
-                send_email.queue(email_message)
-            if event.owner.web_push_notify is True:
-                for token in event.owner.webpush_tokens:
-                    send_push_notification.queue(token, push_data)
+            push_data = push_payload('New Question: {}'.format(event.name), message.text, message.timestamp, event)
 
         elif type(message) is models.Answer:
-            print("Amsreasd")
             send_answer(message)
-            email_subject = "Your question has been answered".format(event.name)
+            recipients = models.User.query.filter_by(id=message.question.questioner_id)
+            email_subject = "Your question has been answered"
             email_body = "{} : {}".format(message.text, message.timestamp)
-            push_data = {
-                "title": 'Answer to your question: {}'.format(event.name),
-                'options': {
-                    "timestamp": message.timestamp.timestamp(),
-                    "tag": "message-group-{}".format(event.url_id),
-                    "body": message.text,
-                    "actions": [
-                        {
-                            "action": "view-event",
-                            "title": "View Event"
-                        }
-                    ],
-                    "renotify": True,
-                    "data": {
-                        "url": flask.url_for('events.view_event', token=event.url_id, _external=True,
-                                             _scheme='https')
-                    }
-                }
-            }  # Possible XSS Attack Vector
-
-            if message.questioner.email_notify is True:
-                email_message = flask_mail.Message(subject=email_subject,
-                                                   recipients=[message.questioner.email],
-                                                   html=flask.render_template("email/text_notification.jinja",
-                                                                              text=email_body,
-                                                                              event=event))
-                send_email.queue(email_message)
-            if message.questioner.web_push_notify is True:
-                for token in message.questioner.webpush_tokens:
-                    send_push_notification.queue(token, push_data)
+            push_data = push_payload('Answer to your question: {}'.format(event.name), message.text,
+                                     message.timestamp, event)
+
+        else:
+            raise TypeError(f"Cannot notify for {type(message).__name__}")
+
+        fan_out(recipients, event, email_subject, email_body, push_data)
@@ -1,25 +1,34 @@
 # coding=utf-8
+import base64
+import binascii
 import functools
+import hashlib
+import io
+import json
 import os
 import random
 import uuid
-from typing import Callable, Dict, Union
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, BinaryIO, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 from urllib.parse import urljoin, urlparse
 
 import faker
 import flask
 import flask_login
-from PIL import Image
+from PIL import Image, ImageOps
 from flask import redirect, request, url_for
-from markdown import markdown
-from mdx_downheader import DownHeaderExtension
+from sqlalchemy import and_, func, or_
 from werkzeug.datastructures import FileStorage
 
 from . import models
-from .extensions import EventNameMarkov, cleaner
+from .extensions import EventNameMarkov, db
 
 fake = faker.Faker()
 
+CURSOR_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
 
 def requires_anonymous(endpoint: Union[str, Callable] = "home.index", msg="You are already logged in"):
     def decorator(func):
@@ -51,49 +60,174 @@ def is_safe_url(target: str) -> bool:
     return test_url.scheme in ('http', 'https') and ref_url.netloc == test_url.netloc
 
 
-def get_unread_messages(user: models.User, count: bool = False) -> Union[
-    Dict[models.Event, models.EventMessage], Dict[models.Event, int]]:
-    messages = {}
-    if count:
-        messages['total'] = 0
-    for subscription in user.subscribed_events:
-        query = models.EventMessage.query.filter(
-                models.EventMessage.timestamp > subscription.last_viewed,
-                models.EventMessage.event == subscription.event
-        )
-        if count:
-            count = query.count()
-            messages[subscription.event] = count
-            messages['total'] += count
-        else:
-            message_list = query.all()
-            messages[subscription.event] = message_list
-    return messages
-
-
-def markdownify(text):
-    return cleaner.clean(markdown(text, extensions=[DownHeaderExtension(levels=3)]))
-
-
-def save_image(img: FileStorage) -> str:
-    directory = os.path.join(flask.current_app.static_folder, flask.current_app.config['UPLOAD_FOLDER'])
-    filename = f"{uuid.uuid4()}.jpeg"
-    save_location = os.path.join(directory, filename)
-
-    # Process Image - Maybe Move To Task?
+def keyset_filter(columns: Sequence[Any], values: Sequence[Any], descending: bool = False):
+    """Selects the rows after `values` in a query ordered (ascending, or descending) by `columns`
+
+    Expanded to (a > x) OR (a = x AND b > y) ... rather than a row value comparison
+    so that it works on every backend.
+    """
+    clauses = []
+    for index, column in enumerate(columns):
+        equal = [c == v for c, v in zip(columns[:index], values[:index])]
+        clauses.append(and_(*equal, column < values[index] if descending else column > values[index]))
+    return or_(*clauses)
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """Serialises the sort key of the last row on a page"""
+    payload = []
+    for value in values:
+        if isinstance(value, datetime):
+            value = value.strftime(CURSOR_DATETIME_FORMAT)
+        elif isinstance(value, Decimal):
+            value = float(value)
+        payload.append(value)
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def decode_cursor(cursor: str, types: Sequence[type]) -> List[Any]:
+    """Reverses `encode_cursor`, raising ValueError if the cursor has been tampered with"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError("Malformed Cursor")
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError("Malformed Cursor")
+    try:
+        return [datetime.strptime(v, CURSOR_DATETIME_FORMAT) if t is datetime else t(v)
+                for v, t in zip(values, types)]
+    except (TypeError, ValueError):
+        raise ValueError("Malformed Cursor")
+
+
+def get_message_page(event_id: int, before: Optional[str] = None) -> Tuple[List[models.EventMessage], Optional[str]]:
+    """A page of an event's messages, newest first, and the cursor for the next (older) page
+
+    Raises ValueError for a malformed cursor.
+    """
+    page_size = flask.current_app.config['MESSAGE_PAGE_SIZE']
+    sort_key = (models.EventMessage.timestamp, models.EventMessage.id)
+    query = models.EventMessage.query.filter(models.EventMessage.event_id == event_id)
+    if before is not None:
+        query = query.filter(keyset_filter(sort_key, decode_cursor(before, [datetime, int]), descending=True))
+    messages = query.order_by(*(column.desc() for column in sort_key)).limit(page_size + 1).all()
+
+    if len(messages) > page_size:
+        last = messages[page_size - 1]
+        return messages[:page_size], encode_cursor((last.timestamp, last.id))
+    return messages, None
+
+
+class UnreadMessages(NamedTuple):
+    count: int
+    latest: models.EventMessage
+
+
+def get_unread_messages(user_id: int, event_ids: List[int]) -> Dict[models.Event, UnreadMessages]:
+    """Unread message count and latest message for each of the given events that has unread messages
+
+    Counts come from the redis counters, so only events with unread messages are queried.
+    Ordered by the latest message, newest first.
+    """
+    counts = {event_id: count for event_id, count in models.Subscription.unread_counts(user_id, event_ids).items()
+              if count > 0}
+    if len(counts) == 0:
+        return OrderedDict()
+
+    # Ids are assigned in insertion order, so the highest id is the latest message
+    latest = db.session.query(
+            models.EventMessage.event_id.label("event_id"),
+            func.max(models.EventMessage.id).label("latest_id")
+    ).filter(models.EventMessage.event_id.in_(counts)).group_by(models.EventMessage.event_id).subquery()
+
+    rows = db.session.query(models.Event, models.EventMessage).join(
+            latest, latest.c.event_id == models.Event.id
+    ).join(
+            models.EventMessage, models.EventMessage.id == latest.c.latest_id
+    ).order_by(models.EventMessage.timestamp.desc())
+
+    return OrderedDict((event, UnreadMessages(counts[event.id], message)) for event, message in rows)
+
+
+def spool_path(name: str) -> str:
+    return os.path.join(flask.current_app.instance_path, flask.current_app.config['IMAGE_SPOOL_FOLDER'], name)
+
+
+def spool_upload(img: FileStorage) -> str:
+    """Writes an uploaded image to the spool folder to be processed by `tasks.process_image_message`
+
+    Only the image header is read here, raises ValueError if it's too small and OSError if it isn't an image.
+    """
     with Image.open(img.stream) as img_handle:
         if img_handle.height < 100 or img_handle.width < 100:
             raise ValueError("Image Too Small")
-        else:
-            if img_handle.width < 800:
-                width = img_handle.width
-            else:
-                width = 800
-            img_handle.thumbnail((width, img_handle.height), Image.LANCZOS)
-            img_handle = img_handle.convert(mode="RGB")  # JPEG has no alpha channel
-            img_handle.save(save_location, optimize=True, quality=75)
-            img_handle.verify()
-    return filename
+    img.stream.seek(0)
+
+    name = f"{uuid.uuid4()}.upload"
+    os.makedirs(os.path.dirname(spool_path(name)), exist_ok=True)
+    img.save(spool_path(name))
+    return name
+
+
+def save_image(img: Union[BinaryIO, str]) -> Dict[str, Any]:
+    """Stores an image under the hash of its content, along with JPEG and WebP copies at each of IMAGE_WIDTHS
+
+    Returns the message data describing the stored image. Identical uploads share their files,
+    and derivatives that already exist aren't generated again. Only the re-encoded derivatives are public,
+    the original, which may carry EXIF data such as a location, is kept in the instance folder.
+    """
+    config = flask.current_app.config
+    directory = os.path.join(flask.current_app.static_folder, config['UPLOAD_FOLDER'])
+    originals = os.path.join(flask.current_app.instance_path, config['IMAGE_ORIGINALS_FOLDER'])
+    os.makedirs(directory, exist_ok=True)
+    os.makedirs(originals, exist_ok=True)
+
+    if isinstance(img, str):
+        with open(img, 'rb') as file:
+            content = file.read()
+    else:
+        content = img.read()
+    digest = hashlib.sha256(content).hexdigest()
+
+    with Image.open(io.BytesIO(content)) as img_handle:
+        if img_handle.height < 100 or img_handle.width < 100:
+            raise ValueError("Image Too Small")
+
+        original = os.path.join(originals, f"{digest}.{img_handle.format.lower()}")
+        if not os.path.exists(original):
+            def write_original(path: str) -> None:
+                with open(path, 'wb') as file:
+                    file.write(content)
+
+            _write_atomically(original, write_original)
+
+        # Derivatives are saved without metadata, so apply the EXIF orientation before measuring the image
+        transposed = ImageOps.exif_transpose(img_handle).convert(mode="RGB")  # JPEG has no alpha channel
+        largest = min(transposed.width, max(config['IMAGE_WIDTHS']))
+        widths = sorted({width for width in config['IMAGE_WIDTHS'] if width < largest} | {largest})
+        for width in widths:
+            resized = None
+            for extension, options in (("jpeg", {"optimize": True, "quality": 75}), ("webp", {"quality": 75})):
+                location = os.path.join(directory, models.image_filename(digest, width, extension))
+                if os.path.exists(location):
+                    continue
+                if resized is None:
+                    resized = transposed.copy()
+                    resized.thumbnail((width, transposed.height), Image.LANCZOS)
+                _write_atomically(location, lambda path: resized.save(path, format=extension, **options))
+
+    return {"file": models.image_filename(digest, largest, "jpeg"), "hash": digest, "widths": widths}
+
+
+def _write_atomically(location: str, write: Callable[[str], Any]) -> None:
+    """Writes to a temporary file first, so concurrent uploads of the same image never see a partial file"""
+    temporary = f"{location}.{uuid.uuid4()}.tmp"
+    try:
+        write(temporary)
+        os.replace(temporary, location)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
 
 
 def event_factory(user: models.User, model: EventNameMarkov):
@@ -1,16 +1,20 @@
 # coding=utf-8
 import decimal
 import uuid
+from datetime import datetime
 from secrets import token_urlsafe
 from typing import Optional
 
 import flask
 import flask_login
 from flask_login import current_user, login_required
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
 
 from event_app.models import MessageTypes
-from .. import forms, models, tasks, utils
+from .. import forms, fragments, models, rendering, tasks, utils
 from ..extensions import db, redis_store
+from ..views.sse import forget_channel
 from ..views.users import send_validation_email
 
 ajax = flask.Blueprint('ajax', __name__, url_prefix="/ajax")
@@ -70,6 +74,7 @@ def update_settings():
     if email_notif is not None:
         current_user.email_notify = utils.translate_json_bool(email_notif)
     if email is not None:
+        forget_channel(current_user.email)
         current_user.email = email
         current_user.email_verified = False
         token = str(token_urlsafe())
@@ -94,22 +99,23 @@ def update_settings():
 @ajax.route('/event/update_subscription', methods=("POST",))
 @login_required
 def update_subscription():
-    event: models.Event = models.Event.fetch_from_url_token(flask.request.form['token'])
+    event: models.EventRef = models.Event.ref_from_url_token(flask.request.form['token'])
     if event is None:
         flask.abort(404)
 
-    if event in current_user.events:
+    if event.owner_id == current_user.id:
         return flask.jsonify(error="Cannot subscribe to own event"), 400
     subscription: models.Subscription = models.Subscription.query.get((current_user.id, event.id))
 
     # Toggle Subscription
     if subscription is None:
-        sub = models.Subscription(user=current_user, event=event)
+        sub = models.Subscription(user_id=current_user.id, event_id=event.id)
         db.session.add(sub)
     else:
         db.session.delete(subscription)
 
     db.session.commit()
+    models.Subscription.reset_unread_count(current_user.id, event.id)
     return flask.jsonify(subscribed=(subscription is None))
 
 
@@ -121,11 +127,11 @@ def event_add_message():
         type_: MessageTypes = MessageTypes(flask.request.form['type'])
     except (KeyError, ValueError):  # If not valid type
         flask.abort(400)
-    event: models.Event = models.Event.fetch_from_url_token(token)
+    event: models.EventRef = models.Event.ref_from_url_token(token)
     if event is None:
         flask.abort(400)  # If not valid event token
     else:
-        if event.owner != flask_login.current_user:
+        if event.owner_id != flask_login.current_user.id:
             flask.abort(403)
 
     title: Optional[str] = flask.request.form.get('title', None)
@@ -144,7 +150,8 @@ def event_add_message():
 
         data = {
             "title": title,
-            "message": utils.markdownify(message)
+            "message": rendering.render(message),
+            "source": message
         }
 
     elif type_ is MessageTypes.IMAGE:
@@ -152,17 +159,26 @@ def event_add_message():
         if len(image.filename) == 0 or \
                 image.mimetype not in flask.current_app.config['ALLOWED_IMAGE_MIMETYPES']:
             flask.abort(400)
-        name = utils.save_image(image)
-        data = {"file": name, "title": title}
+        try:
+            upload = utils.spool_upload(image)
+        except (ValueError, OSError):
+            flask.abort(400)
+
+        # Resizing takes a while, the message is posted once it's done
+        # noinspection PyUnboundLocalVariable
+        tasks.process_image_message.queue(event.id, upload, title)
+        return "Accepted", 202
     else:  # Unknown Type
         flask.abort(400)
 
     # noinspection PyUnboundLocalVariable
-    message = models.EventMessage(event=event, type=type_, data=data)
+    message = models.EventMessage(event_id=event.id, type=type_, data=data)
     db.session.add(message)
     db.session.commit()
+    models.Subscription.count_unread_message(message)
+    fragments.bump_version(event.id)
 
-    tasks.notify.queue(message, event)
+    tasks.notify.queue("message", message.id)
     return "Ok", 201
 
 
@@ -179,19 +195,39 @@ def event_remove_message():
     if message is None:
         flask.abort(400)  # If not valid message id
     else:
-        if message.event.owner != flask_login.current_user:
+        if models.Event.ref(message.event_id).owner_id != flask_login.current_user.id:
             flask.abort(403)
 
+    event_id = message.event_id
+    models.Subscription.count_unread_message(message, amount=-1)
     db.session.delete(message)
     db.session.commit()
+    fragments.bump_version(event_id)
     return '', 204
 
 
+@ajax.route('/event/messages')
+@login_required
+def event_messages():
+    """Older pages of an event's message timeline"""
+    event: models.EventRef = models.Event.ref_from_url_token(flask.request.args.get('event', ''))
+    if event is None:
+        flask.abort(400)  # If not valid event token
+    try:
+        messages, next_cursor = utils.get_message_page(event.id, flask.request.args['before'])
+    except (KeyError, ValueError):
+        flask.abort(400)
+
+    html = flask.render_template("events/message_timeline.jinja", messages=messages,
+                                 owner=event.owner_id == current_user.id)
+    return flask.jsonify(html=html, next=next_cursor)
+
+
 @ajax.route('/event/update_viewed_messages', methods=("POST",))
 @login_required
 def event_viewed_message():
     event_id: str = flask.request.form['event']
-    event: models.Event = models.Event.fetch_from_url_token(event_id)
+    event: models.EventRef = models.Event.ref_from_url_token(event_id)
     if event is None:
         flask.abort(400)  # If not valid event token
 
@@ -208,19 +244,19 @@ def event_viewed_message():
 @login_required
 def event_add_question():
     token: str = flask.request.form['token']
-    event: models.Event = models.Event.fetch_from_url_token(token)
+    event: models.EventRef = models.Event.ref_from_url_token(token)
     if event is None:
         flask.abort(400)
     else:
-        if event.owner == flask_login.current_user:
+        if event.owner_id == flask_login.current_user.id:
             flask.abort(400)
 
-    question = models.Question(event=event, text=flask.request.form['message'],
+    question = models.Question(event_id=event.id, text=flask.request.form['message'],
                                questioner=current_user)
     db.session.add(question)
     db.session.commit()
 
-    tasks.notify.queue(question, event)
+    tasks.notify.queue("question", question.id)
     return "Ok", 201
 
 
@@ -237,14 +273,15 @@ def event_add_answer():
         flask.abort(400)
     if len(reply) == 0:
         flask.abort(400)
-    if flask_login.current_user != question.event.owner:
+    if flask_login.current_user.id != models.Event.ref(question.event_id).owner_id:
         flask.abort(403)
 
     answer = models.Answer(question=question, text=reply, private=private)
     db.session.add(answer)
     db.session.commit()
+    fragments.bump_version(question.event_id)
 
-    tasks.notify.queue(answer, question.event)
+    tasks.notify.queue("answer", answer.id)
     return "Ok", 201
 
 
@@ -287,26 +324,53 @@ def update_location():
 
 @ajax.route('/events')
 def get_events():
-    lat = decimal.Decimal(flask.request.args['lat'])
-    lng = decimal.Decimal(flask.request.args['lng'])
+    """Map markers for the public events inside a viewport"""
+    try:
+        north = decimal.Decimal(flask.request.args['north'])
+        south = decimal.Decimal(flask.request.args['south'])
+        east = decimal.Decimal(flask.request.args['east'])
+        west = decimal.Decimal(flask.request.args['west'])
+    except (KeyError, decimal.InvalidOperation):
+        return flask.abort(400)
 
-    events = models.Event.query.filter_by(
-            models.Event.distance_from(lat, lng) <= flask.current_app.config['EVENT_MAXIMUM_DISTANCE']
-    ).order_by(
-            models.Event.distance_from(lat, lng),
-            models.Event.time
-    ).all()
+    if west <= east:
+        longitude_filter = models.Event.longitude.between(west, east)
+    else:  # Viewport crosses the antimeridian
+        longitude_filter = or_(models.Event.longitude >= west, models.Event.longitude <= east)
+
+    sort_key = [models.Event.start, models.Event.id]
+    query = models.Event.query.options(
+            joinedload(models.Event.owner)
+    ).filter(
+            models.Event.latitude.between(south, north),
+            longitude_filter,
+            models.Event.private == False
+    )
+    cursor = flask.request.args.get('after')
+    if cursor is not None:
+        try:
+            query = query.filter(utils.keyset_filter(sort_key, utils.decode_cursor(cursor, [datetime, int])))
+        except ValueError:
+            return flask.abort(400)
+
+    limit = flask.current_app.config['MAP_MARKER_LIMIT']
+    events = query.order_by(*sort_key).limit(limit + 1).all()
 
     return_value = []
-    for event in events:
+    for event in events[:limit]:
         return_value.append({
+            'id': event.url_id,
             'name': event.name,
             'coords': {
-                'lat': event.latitude,
-                'lng': event.longitude
+                'lat': float(event.latitude),
+                'lng': float(event.longitude)
             },
             'owner': {
                 'name': event.owner.full_name,
             }
         })
-    return flask.jsonify(return_value)
+    if len(events) > limit:
+        next_cursor = utils.encode_cursor([events[limit - 1].start, events[limit - 1].id])
+    else:
+        next_cursor = None
+    return flask.jsonify(events=return_value, next=next_cursor)
@@ -1,28 +1,54 @@
 # coding=utf-8
-from typing import List
+import math
+from datetime import datetime
+from typing import List, Optional, Tuple
 
 import flask
 from flask_login import current_user, login_required
-from sqlalchemy import or_
+from markupsafe import Markup
+from sqlalchemy import and_, case, exists, null
+from sqlalchemy.orm import joinedload
 
 from event_app.models import MessageTypes
-from .. import forms, models, utils
-from ..extensions import db
+from .. import forms, fragments, geo, models, rendering, utils
+from ..cache import DiscoverKey
+from ..extensions import db, discover_cache
 
 events = flask.Blueprint('events', __name__)
 
+_SORT_KEY_TYPES = {
+    "distance": float,
+    "start": datetime,
+    "name": str
+}
+
+_UNLOCATED_DISTANCE = math.pi * geo.EARTH_RADIUS + 1  # Further than anywhere, so events without a location sort last
+
 
 # noinspection PyCallByClass
 @events.route('/discover')
 @login_required
 def discover() -> flask.Response:
     if current_user.location_enabled:
-        _distance_query = models.Event.distance_from(current_user.latitude, current_user.longitude)
+        # Everyone in the same cell shares the results for its centre
+        cell = discover_cache.cell(current_user.latitude, current_user.longitude)
+        latitude, longitude, _, _ = geo.decode_geohash(cell)
+        # Never NULL, so every row has a cursor that decodes and compares
+        order_columns = {
+            "distance": case([(models.Event.location_enabled, models.Event.distance_from(latitude, longitude))],
+                             else_=_UNLOCATED_DISTANCE),
+            "start": models.Event.start,
+            "name": models.Event.name
+        }
     else:
-        _distance_query = None  # Reference to allow dictionary use
+        cell = None
+        order_columns = {
+            "start": models.Event.start,
+            "name": models.Event.name
+        }
 
     # Order
-    order_preference = [_distance_query, "start", "name"]
+    order_preference = [key for key in ("distance", "start", "name") if key in order_columns]
     order_by_string = flask.request.args.get('order')
     if order_by_string is not None:
         if order_by_string == "time":
@@ -30,15 +56,13 @@ def discover() -> flask.Response:
         elif order_by_string == "name":
             order = "name"
         elif order_by_string == "distance" and current_user.location_enabled:
-            order = _distance_query
+            order = "distance"
         else:
             return flask.abort(400)
 
         # Prioritise selected order
         order_preference.remove(order)
         order_preference.insert(0, order)
-    # Remove None From Priority List
-    order_preference[:] = [x for x in order_preference if x is not None]
 
     # Distance
     distance_param = flask.request.args.get('dist', 'far')
@@ -53,17 +77,49 @@ def discover() -> flask.Response:
     else:
         return flask.abort(400)
 
-    if current_user.location_enabled and max_distance is not None:
-        events_ = models.Event.query.filter(
-                models.Event.distance_from(current_user.latitude, current_user.longitude) <= max_distance,
-                models.Event.private == False
-        ).order_by(*order_preference).all()
+    if not current_user.location_enabled:
+        max_distance = None
+
+    # Keyset pagination: (order columns..., id) of the last event on the previous page
+    sort_key = [order_columns[key] for key in order_preference] + [models.Event.id]
+    cursor: Optional[str] = flask.request.args.get('after')
+    cache_key = DiscoverKey(cell=cell, max_distance=max_distance, order=order_by_string, cursor=cursor)
+    page: Optional[Tuple[List[int], Optional[str]]] = discover_cache.get(cache_key)
+    if page is None:
+        query = db.session.query(*sort_key).filter(models.Event.private == False)
+        if max_distance is not None:
+            query = query.filter(models.Event.within_distance(latitude, longitude, max_distance))
+        if cursor is not None:
+            try:
+                after = utils.decode_cursor(cursor, [_SORT_KEY_TYPES[key] for key in order_preference] + [int])
+            except ValueError:
+                return flask.abort(400)
+            query = query.filter(utils.keyset_filter(sort_key, after))
+
+        page_size = flask.current_app.config['DISCOVER_PAGE_SIZE']
+        rows = query.order_by(*sort_key).limit(page_size + 1).all()
+        next_cursor = utils.encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+        page = ([row[-1] for row in rows[:page_size]], next_cursor)
+        discover_cache.set(cache_key, page)
+
+    event_ids, next_cursor = page
+    if len(event_ids) > 0:
+        # Everything a card needs in one query, rather than a few per card
+        subscribed = exists().where(and_(
+                models.Subscription.event_id == models.Event.id,
+                models.Subscription.user_id == current_user.id
+        )).label("subscribed")
+        if current_user.location_enabled:
+            distance = models.Event.distance_from(current_user.latitude, current_user.longitude).label("distance")
+        else:
+            distance = null().label("distance")
+        position = {id_: index for index, id_ in enumerate(event_ids)}
+        cards = sorted(db.session.query(models.Event, subscribed, distance).filter(models.Event.id.in_(event_ids)),
+                       key=lambda row: position[row[0].id])
     else:
-        events_ = models.Event.query.filter(
-                models.Event.private == False
-        ).order_by(*order_preference).all()
+        cards = []
 
-    return flask.render_template("events/discover.jinja", events=events_)
+    return flask.render_template("events/discover.jinja", cards=cards, next_cursor=next_cursor)
 
 
 @events.route('/event/create', methods=("GET", "POST"))
@@ -73,21 +129,21 @@ def create_event() -> flask.Response:
     if form.validate_on_submit():
 
         description = form.description.data
-        if description is not None:
-            if len(description.strip()) == 0:
-                description = None
-            else:
-                description = utils.markdownify(description)
+        if description is not None and len(description.strip()) == 0:
+            description = None
 
         new_event = models.Event(owner=current_user,
                                  name=form.name.data,
-                                 description=description,
+                                 description=None if description is None else rendering.render(description),
+                                 description_source=description,
                                  private=form.private.data,
                                  start=form.start.data,
                                  latitude=form.latitude.data,
                                  longitude=form.longitude.data)
         db.session.add(new_event)
         db.session.commit()
+        if not new_event.private:
+            discover_cache.invalidate(new_event.latitude, new_event.longitude)
         return flask.redirect("/event/{}".format(new_event.url_id))
     return flask.render_template("events/create.jinja", form=form)
 
@@ -105,23 +161,20 @@ def view_event(token):
     if subscribed:
         subscription.update()
 
-    owner: bool = event in current_user.events
-    messages: List[models.EventMessage] = models.EventMessage.query.filter_by(event=event).order_by(
-            models.EventMessage.timestamp.desc()).all()
-    # noinspection PyComparisonWithNone
-    answered_questions: List[models.Question] = models.Question.query.filter(
-            models.Question.event == event,
-            models.Question.answer != None,
-            or_(
-                    models.Question.answer.has(private=False),
-                    models.Question.questioner == current_user
-            )
-    ).order_by(models.Question.timestamp.desc()).all()
+    owner: bool = event.owner_id == current_user.id
+    timeline = fragments.cached_fragment(event.id, "timeline", lambda: _render_timeline(event, owner),
+                                         variant="owner" if owner else "viewer")
+    # Public answers are the same for everyone and cached, the viewer's own private ones are merged in by time
+    answered = sorted(fragments.cached_pieces(event.id, "answers", lambda: _render_answers(event, private=False))
+                      + _render_answers(event, private=True), key=lambda piece: piece.sort_key, reverse=True)
+    answered_questions = Markup("".join(piece.html for piece in answered))
 
     base_kwargs = {
         "event": event,
         "user": current_user,
-        "messages": messages,
+        "timeline": timeline,
+        "answered_questions": answered_questions,
+        "answered_question_count": len(answered)
     }
 
     if owner:
@@ -134,8 +187,7 @@ def view_event(token):
                                      owner=True,
                                      message_types=MessageTypes,
                                      unanswered_question_count=unanswered_question_count,
-                                     unanswered_questions=unanswered_questions,
-                                     answered_questions=answered_questions)
+                                     unanswered_questions=unanswered_questions)
     else:
         unanswered_question_count = models.Question.query.filter_by(event=event, answer=None,
                                                                     questioner=current_user).count()
@@ -144,8 +196,32 @@ def view_event(token):
                                      **base_kwargs,
                                      subscribed=subscribed,
                                      owner=False,
-                                     unanswered_question_count=unanswered_question_count,
-                                     answered_questions=answered_questions)
+                                     unanswered_question_count=unanswered_question_count)
+
+
+def _render_timeline(event: models.Event, owner: bool) -> Tuple[str, int]:
+    """The newest page of messages, older pages are fetched from `ajax.event_messages`"""
+    messages, next_cursor = utils.get_message_page(event.id)
+    return flask.render_template("events/message_timeline.jinja", messages=messages, owner=owner,
+                                 event=event, next_cursor=next_cursor), len(messages)
+
+
+def _render_answers(event: models.Event, private: bool) -> List[fragments.Piece]:
+    """Answered questions, each rendered separately so public and private ones can be merged in order
+
+    Private answers are only those to the current user's questions.
+    """
+    query = models.Question.query.options(
+            joinedload(models.Question.answer)
+    ).filter(
+            models.Question.event == event,
+            models.Question.answer.has(private=private)
+    )
+    if private:
+        query = query.filter(models.Question.questioner == current_user)
+    return [fragments.Piece([question.timestamp.strftime(utils.CURSOR_DATETIME_FORMAT), question.id],
+                            flask.render_template("events/answered_questions.jinja", questions=[question]))
+            for question in query]
 
 
 @events.route('/event/<token>/questions')
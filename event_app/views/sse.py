@@ -1,15 +1,94 @@
 # coding=utf-8
 import base64
 import hashlib
-from typing import Optional
+import json
+from typing import Iterator, List, Optional, Union
 
+import flask
 import flask_login
 from flask import abort, request
-from flask_sse import ServerSentEventsBlueprint
+from flask_sse import Message, ServerSentEventsBlueprint
+from redis.exceptions import ConnectionError
 
 from .. import models
-
-sse = ServerSentEventsBlueprint('sse', __name__)
+from ..cache import LRUCache
+from ..extensions import db, redis_store
+
+EVENT_ID_KEY = 'SSE:EVENT_ID'
+
+_channels = LRUCache(maxsize=4096)  # email -> channel id, hashing on every render and publish adds up
+
+
+class EventStreamBlueprint(ServerSentEventsBlueprint):
+    """Streams a user's own channel together with the topics of the events they are subscribed to
+
+    Messages for an event are published once to its topic rather than once per subscriber. Every message is given
+    an increasing id and kept in a short per-channel replay log, so a reconnecting client sending `Last-Event-ID`
+    only receives what it missed.
+    """
+
+    @property
+    def redis(self):
+        return redis_store
+
+    def publish(self, data, type=None, id=None, retry=None, channel='sse'):
+        if id is None:
+            id = self.redis.incr(EVENT_ID_KEY)
+        message = Message(data, type=type, id=id, retry=retry)
+        msg_json = json.dumps(message.to_dict())
+        replay_key = get_replay_key(channel)
+        config = flask.current_app.config
+
+        pipe = self.redis.pipeline()
+        pipe.zadd(replay_key, id, msg_json)
+        pipe.zremrangebyrank(replay_key, 0, -config['SSE_REPLAY_SIZE'] - 1)
+        pipe.expire(replay_key, config['SSE_REPLAY_TTL'])
+        pipe.publish(channel, msg_json)
+        pipe.execute()
+
+    def replay(self, channels: List[str], last_event_id: int) -> List[Message]:
+        """Messages published to any of `channels` after `last_event_id`, oldest first"""
+        pipe = self.redis.pipeline()
+        for channel in channels:
+            pipe.zrangebyscore(get_replay_key(channel), '({}'.format(last_event_id), '+inf')
+        messages = [Message(**json.loads(data)) for results in pipe.execute() for data in results]
+        return sorted(messages, key=lambda message: message.id)
+
+    def messages(self, channels: List[str], last_event_id: Optional[int] = None) -> Iterator[Message]:
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe(*channels)  # Subscribe before replaying so nothing published in between is lost
+        try:
+            replayed = set()
+            if last_event_id is not None:
+                for message in self.replay(channels, last_event_id):
+                    replayed.add(message.id)
+                    yield message
+            for pubsub_message in pubsub.listen():
+                if pubsub_message['type'] == 'message':
+                    message = Message(**json.loads(pubsub_message['data']))
+                    if message.id not in replayed:
+                        yield message
+        finally:
+            try:
+                pubsub.unsubscribe()
+                pubsub.close()
+            except ConnectionError:
+                pass
+
+    def stream(self):
+        channels = [request.args['channel']] + subscribed_topics(flask_login.current_user)
+        last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID'))
+        db.session.close()  # Don't hold a database connection for the life of the stream
+
+        @flask.stream_with_context
+        def generator():
+            for message in self.messages(channels, last_event_id):
+                yield str(message)
+
+        return flask.current_app.response_class(generator(), mimetype='text/event-stream')
+
+
+sse = EventStreamBlueprint('sse', __name__)
 
 
 @sse.before_request
@@ -25,21 +104,55 @@ def is_authorised(requested_channel: str, user: Optional[models.User] = None) ->
     return flask_login.current_user.is_authenticated and get_channel(user) == requested_channel
 
 
-def get_channel(user: Optional[models.User] = None):
+def get_event_topic(event: Union[models.Event, int]) -> str:
+    event_id = event if isinstance(event, int) else event.id
+    return 'EVENT#{}'.format(event_id)
+
+
+def get_replay_key(channel: str) -> str:
+    return 'SSE:REPLAY#{}'.format(channel)
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def subscribed_topics(user: models.User) -> List[str]:
+    subscriptions = db.session.query(models.Subscription.event_id).filter_by(user_id=user.id)
+    return [get_event_topic(event_id) for event_id, in subscriptions]
+
+
+def get_channel(user: Optional[models.User] = None) -> str:
     if user is None:
         user = flask_login.current_user
-    return base64.urlsafe_b64encode(hashlib.sha256(user.email.encode()).digest()).decode()
+    channel = _channels.get(user.email)
+    if channel is None:
+        channel = hash_channel(user.email)
+        _channels.set(user.email, channel)
+    return channel
+
+
+def hash_channel(email: str) -> str:
+    return base64.urlsafe_b64encode(hashlib.sha256(email.encode()).digest()).decode()
+
+
+def forget_channel(email: str) -> None:
+    """Drops a memoised channel id, call when a user's email changes"""
+    _channels.pop(email)
 
 
-def send_message(message: models.EventMessage):
+def send_message(message: models.EventMessage, channel: Optional[str] = None):
+    """Publishes a message to its event's topic, or to `channel`"""
     data = {
         "type": message.type.value,
         "data": message.data,
         "rendered": message.render(),
         "event": message.event.url_id
     }
-    for subscription in message.event.subscriptions:
-        sse.publish(data, channel=get_channel(subscription.user), type="message")
+    sse.publish(data, channel=get_event_topic(message.event_id) if channel is None else channel, type="message")
 
 
 def send_question(question: models.Question):
@@ -64,5 +177,4 @@ def send_answer(answer: models.Answer):
     if answer.private:
         sse.publish(data, channel=get_channel(answer.question.questioner), type="answer")
     else:
-        for subscription in answer.question.event.subscriptions:
-            sse.publish(data, channel=get_channel(subscription.user), type="answer")
+        sse.publish(data, channel=get_event_topic(answer.question.event_id), type="answer")
@@ -1,6 +1,6 @@
 # coding=utf-8
 from secrets import token_urlsafe
-from typing import Optional, Union
+from typing import Dict, Optional
 
 import flask
 import flask_login
@@ -8,9 +8,11 @@ import flask_mail
 from flask import Blueprint, render_template
 from flask_limiter.util import get_remote_address
 from flask_login import current_user, login_required, login_user, logout_user
+from sqlalchemy.orm import joinedload
 
-from .. import forms, models, tasks, utils
+from .. import forms, mailer, models, utils
 from ..extensions import db, limiter, redis_store
+from ..lockout import login_lockout, recovery_lockout
 
 users = Blueprint('users', __name__)
 
@@ -20,7 +22,7 @@ def send_validation_email(user: models.User, validation_token: str):
         email = "chadfield.jackson+debug@gmail.com" if flask.helpers.get_debug_flag() else user.email
         msg = flask_mail.Message("Account Verification", recipients=[email])
         msg.html = flask.render_template('email/verification.jinja', user=user, token=validation_token)
-        tasks.send_email.queue(msg)
+        mailer.queue_emails([msg])
 
 
 def send_recovery_email(user: models.User, recovery_token: str):
@@ -28,10 +30,10 @@ def send_recovery_email(user: models.User, recovery_token: str):
         email = "chadfield.jackson+debug@gmail.com" if flask.helpers.get_debug_flag() else user.email
         msg = flask_mail.Message("Account Recovery", recipients=[email])
         msg.html = flask.render_template('email/recovery.jinja', user=user, token=recovery_token)
-        tasks.send_email.queue(msg)
+        mailer.queue_emails([msg])
 
 
-def generate_insights(user: models.User):
+def generate_insights(user: models.User, unread_messages: Dict[models.Event, utils.UnreadMessages]):
     # noinspection PyListCreation
     insights = {
         "warning": [],
@@ -75,10 +77,10 @@ def generate_insights(user: models.User):
             ]
         })
 
-    for event, messages in utils.get_unread_messages(current_user).items():
-        count = len(messages)
+    for event, unread in unread_messages.items():
+        count = unread.count
         if count == 1:
-            message: models.EventMessage = messages[0]
+            message: models.EventMessage = unread.latest
             if message.type is models.MessageTypes.TEXT:
                 insights["standard"].append({
                     "title": event.name,
@@ -126,14 +128,16 @@ def dashboard() -> flask.Response:
     """
     unanswered_questions = models.Question.query.filter(models.Question.answer == None, models.Question.event.has(
             owner=current_user)).count()
-    unread_messages = utils.get_unread_messages(current_user, count=True)
-    insights = generate_insights(current_user)
+    subscribed = current_user.subscribed_events.options(joinedload(models.Subscription.event)).all()
+    unread_messages = utils.get_unread_messages(current_user.id,
+                                                [subscription.event_id for subscription in subscribed])
+    insights = generate_insights(current_user, unread_messages)
     return flask.render_template("users/dashboard.jinja",
                                  insights=insights,
-                                 subscribed=current_user.subscribed_events,
+                                 subscribed=subscribed,
                                  owned=current_user.events,
                                  unanswered_questions=unanswered_questions,
-                                 unread_messages=unread_messages)
+                                 unread_total=sum(unread.count for unread in unread_messages.values()))
 
 
 @users.route('/login', methods=("GET", "POST"))
@@ -141,20 +145,13 @@ def dashboard() -> flask.Response:
 def login():
     login_form = forms.LoginForm()
     if flask.request.method == "POST":
-        attempts: Union[bytes, None] = redis_store.get('USER:LOGIN_FAILURES#{}'.format(get_remote_address()))
-        if attempts is not None and (int(attempts) >= flask.current_app.config["LOCKDOWN_AFTER_N_PASSWORD_ATTEMPTS"]):
+        if not login_lockout.attempt(get_remote_address()):
             return render_template('users/login.jinja', form=login_form, lockout=True)
         elif login_form.validate():
-            # Reset Attempt Count
-            redis_store.delete('USER:LOGIN_FAILURES#{}'.format(get_remote_address()))
+            login_lockout.reset(get_remote_address())
             login_user(login_form.user)
             flask.flash({"body": "Logged In Successfully"}, "success")
             return utils.redirect_with_next('home.index')
-        else:
-            redis_store.incr('USER:LOGIN_FAILURES#{}'.format(get_remote_address()))
-            # Reset Expiry Time
-            redis_store.expire('USER:LOGIN_FAILURES#{}'.format(get_remote_address()),
-                               flask.current_app.config["LOCKDOWN_FOR_N_SECONDS"])
     return render_template('users/login.jinja', form=login_form, lockout=False)
 
 
@@ -238,19 +235,19 @@ def recovery_change_password(token):
     if user is None:
         flask.abort(404)
     if flask.request.method == "POST":
+        if not recovery_lockout.attempt(token):
+            return flask.render_template('users/recovery_phase_2_minimal.jinja', form=form, token=token, lockout=True)
         if form.validate() \
                 and form.email.data == user_email.decode() \
                 and form.first_name.data.lower().strip() == user.first_name.lower().strip():
             redis_store.delete('USER:RECOVERY_TOKEN#{}'.format(token))
+            recovery_lockout.reset(token)
             user.password = form.password.data
             db.session.commit()
             flask.flash({"body": "Password Has Been Reset"}, "success")
             login_user(user)
             return flask.redirect(flask.url_for("home.index"))
-        else:
-            # TODO: Implement Lockout
-            pass
-    return flask.render_template('users/recovery_phase_2_minimal.jinja', form=form, token=token)
+    return flask.render_template('users/recovery_phase_2_minimal.jinja', form=form, token=token, lockout=False)
 
 
 @users.route('/logout', methods=("POST",))
@@ -0,0 +1,77 @@
+# coding=utf-8
+from unittest import TestCase, mock
+
+import flask
+import hashids
+
+from event_app import geo
+from event_app.cache import DiscoverCache, DiscoverKey, LRUCache, UrlTokenCodec
+
+
+class TestLRUCache(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_counts_hits_and_misses(self):
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_expiry(self):
+        cache = LRUCache(ttl=-1)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+class TestDiscoverCache(TestCase):
+
+    def test_invalidates_affected_cells(self):
+        cache = DiscoverCache()
+        auckland = cache.cell(-36.85, 174.76)
+        wellington = cache.cell(-41.29, 174.78)
+        cache.set(DiscoverKey(auckland, 10, None), [1])
+        cache.set(DiscoverKey(wellington, 10, None), [2])
+        cache.set(DiscoverKey(wellington, None, None), [2])
+        cache.set(DiscoverKey(None, None, "name"), [1, 2])
+
+        self.assertEqual(cache.invalidate(-36.86, 174.77), 3)
+        self.assertIsNone(cache.get(DiscoverKey(auckland, 10, None)))
+        self.assertEqual(cache.get(DiscoverKey(wellington, 10, None)), [2])
+
+    def test_geohash_round_trip(self):
+        latitude, longitude, lat_error, lng_error = geo.decode_geohash(geo.encode_geohash(-36.85, 174.76, 6))
+        self.assertAlmostEqual(latitude, -36.85, delta=lat_error)
+        self.assertAlmostEqual(longitude, 174.76, delta=lng_error)
+
+
+class TestUrlTokenCodec(TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config.update(HASHID_SALT="salt", URL_TOKEN_CACHE_SIZE=16)
+        self.codec = UrlTokenCodec(app)
+
+    def test_matches_hashids(self):
+        expected = hashids.Hashids(min_length=10, salt="salt")
+        for id_ in (1, 42, 10 ** 6):
+            token = self.codec.encode(id_)
+            self.assertEqual(token, expected.encode(id_))
+            self.assertEqual(self.codec.decode(token), id_)
+            self.assertEqual(self.codec.decode(expected.encode(id_)), id_)
+        self.assertIsNone(self.codec.decode("not a token"))
+
+    def test_encoder_built_once(self):
+        with mock.patch('event_app.cache.hashids.Hashids', wraps=hashids.Hashids) as constructor:
+            for id_ in range(50):
+                self.codec.decode(self.codec.encode(id_))
+            self.assertEqual(constructor.call_count, 1)
@@ -0,0 +1,226 @@
+# coding=utf-8
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+import flask
+from flask_testing import TestCase
+from sqlalchemy import event as sqlalchemy_event
+
+from event_app import fragments, models, utils
+from event_app.app import create_app
+from event_app.configs import TestingConfig
+from event_app.extensions import db, discover_cache, redis_store
+
+
+class TestDiscoverView(TestCase):
+
+    def create_app(self) -> flask.app.Flask:
+        app = create_app(TestingConfig)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        discover_cache.clear()
+        self.user = models.User("jackson", "chadfield.jackson@gmail.com", "password123")
+        owner = models.User("owner", "owner@example.com", "password123")
+        db.session.add_all([self.user, owner])
+        for i in range(30):
+            event = models.Event(owner=owner, name=f"Event {i}", start=datetime.utcnow() + timedelta(days=i))
+            db.session.add(event)
+            if i % 2 == 0:
+                db.session.add(models.Subscription(user=self.user, event=event))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def count_discover_queries(self, page_size: int) -> int:
+        self.app.config['DISCOVER_PAGE_SIZE'] = page_size
+        discover_cache.clear()
+        models.User.load_by_session_token(self.user.session_token)  # Both runs load the user from its snapshot
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.client as c:
+            with c.session_transaction() as session:
+                session['user_id'] = self.user.session_token
+            sqlalchemy_event.listen(db.engine, "before_cursor_execute", count)
+            try:
+                response = c.get(flask.url_for('events.discover'))
+            finally:
+                sqlalchemy_event.remove(db.engine, "before_cursor_execute", count)
+        self.assert200(response)
+        return len(statements)
+
+    def test_discover_query_count_independent_of_page_size(self):
+        self.assertEqual(self.count_discover_queries(2), self.count_discover_queries(20))
+
+    def test_discover_pages_past_events_without_location(self):
+        self.user.latitude, self.user.longitude = -36.85, 174.76
+        owner = models.User.query.filter_by(email="owner@example.com").one()
+        db.session.add_all(models.Event(owner=owner, name=f"Located {i}", start=datetime.utcnow(),
+                                        latitude=-36.85 + i / 100, longitude=174.76) for i in range(5))
+        db.session.commit()
+        self.app.config['DISCOVER_PAGE_SIZE'] = 4
+
+        seen = []
+        cursor = None
+        with self.client as c:
+            with c.session_transaction() as session:
+                session['user_id'] = self.user.session_token
+            while True:
+                query = {"dist": "all", "order": "distance"}
+                if cursor is not None:
+                    query["after"] = cursor
+                self.assert200(c.get(flask.url_for('events.discover', **query)))
+                seen += [event.name for event, _, _ in self.get_context_variable('cards')]
+                cursor = self.get_context_variable('next_cursor')
+                if cursor is None:
+                    break
+
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(seen[:5], [f"Located {i}" for i in range(5)])
+        self.assertEqual(len(seen), models.Event.query.count())
+
+
+class TestEventRefs(TestCase):
+
+    def create_app(self) -> flask.app.Flask:
+        app = create_app(TestingConfig)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        self.owner = models.User("owner", "owner@example.com", "password123")
+        self.event = models.Event(owner=self.owner, name="Event", start=datetime.utcnow(), private=True)
+        db.session.add(self.event)
+        db.session.commit()
+        redis_store.delete(models.Event.ref_key(self.event.id))
+
+    def tearDown(self):
+        redis_store.delete(models.Event.ref_key(self.event.id))
+        db.session.remove()
+        db.drop_all()
+
+    def test_ref_from_url_token(self):
+        expected = models.EventRef(self.event.id, self.owner.id, True)
+        token = self.event.url_id
+        db.session.expunge_all()
+        with self.app.test_request_context():
+            self.assertEqual(models.Event.ref_from_url_token(token), expected)
+            self.assertIsNone(models.Event.ref_from_url_token("not a token"))
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy_event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            with self.app.test_request_context():
+                self.assertEqual(models.Event.ref_from_url_token(token), expected)
+        finally:
+            sqlalchemy_event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual(statements, [])  # Served from redis
+
+
+class TestEventView(TestCase):
+
+    def create_app(self) -> flask.app.Flask:
+        app = create_app(TestingConfig)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        self.user = models.User("jackson", "chadfield.jackson@gmail.com", "password123")
+        owner = models.User("owner", "owner@example.com", "password123")
+        self.event = models.Event(owner=owner, name="Event", start=datetime.utcnow())
+        db.session.add_all([self.user, self.event, models.Subscription(user=self.user, event=self.event)])
+        db.session.add(models.EventMessage(event=self.event, type=models.MessageTypes.TEXT,
+                                           data={"title": None, "message": "First Message"}))
+        db.session.commit()
+        fragments.bump_version(self.event.id)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def view_event(self) -> Tuple[str, List[str]]:
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.client as c:
+            with c.session_transaction() as session:
+                session['user_id'] = self.user.session_token
+            sqlalchemy_event.listen(db.engine, "before_cursor_execute", count)
+            try:
+                response = c.get(flask.url_for('events.view_event', token=self.event.url_id))
+            finally:
+                sqlalchemy_event.remove(db.engine, "before_cursor_execute", count)
+        self.assert200(response)
+        return response.get_data(as_text=True), [s for s in statements if "FROM eventmessage" in s]
+
+    def test_timeline_fragment_cached_until_version_bump(self):
+        page, message_queries = self.view_event()
+        self.assertIn("First Message", page)
+        self.assertEqual(len(message_queries), 1)
+
+        page, message_queries = self.view_event()
+        self.assertIn("First Message", page)
+        self.assertEqual(message_queries, [])
+
+        db.session.add(models.EventMessage(event_id=self.event.id, type=models.MessageTypes.TEXT,
+                                           data={"title": None, "message": "Second Message"}))
+        db.session.commit()
+        fragments.bump_version(self.event.id)
+        page, message_queries = self.view_event()
+        self.assertIn("Second Message", page)
+
+    def test_private_answers_interleaved_by_time(self):
+        other = models.User("other", "other@example.com", "password123")
+        start = datetime.utcnow()
+        for i, (questioner, private) in enumerate([(other, False), (self.user, True), (other, True), (other, False)]):
+            db.session.add(models.Question(event=self.event, questioner=questioner, text=f"question {i}",
+                                           timestamp=start + timedelta(minutes=i),
+                                           answer=models.Answer(text=f"Answer {i}", private=private)))
+        db.session.commit()
+        fragments.bump_version(self.event.id)
+
+        for _ in range(2):  # Rendered, then cached
+            page, _ = self.view_event()
+            self.assertNotIn("Answer 2", page)  # Someone else's private answer
+            positions = [page.index(f"Answer {i}") for i in (3, 1, 0)]
+            self.assertEqual(positions, sorted(positions))
+
+    def test_older_messages_paginated(self):
+        self.app.config['MESSAGE_PAGE_SIZE'] = 2
+        start = datetime.utcnow()
+        for i in range(4):
+            db.session.add(models.EventMessage(event_id=self.event.id, type=models.MessageTypes.TEXT,
+                                               timestamp=start + timedelta(minutes=i),
+                                               data={"title": None, "message": f"Message {i}"}))
+        db.session.commit()
+        fragments.bump_version(self.event.id)
+
+        page, _ = self.view_event()
+        self.assertIn("Message 3", page)
+        self.assertIn("Message 2", page)
+        self.assertNotIn("Message 1", page)
+
+        messages, cursor = utils.get_message_page(self.event.id)
+        seen = [message.data["message"] for message in messages]
+        with self.client as c:
+            with c.session_transaction() as session:
+                session['user_id'] = self.user.session_token
+            while cursor is not None:
+                response = c.get(flask.url_for('ajax.event_messages', event=self.event.url_id, before=cursor))
+                self.assert200(response)
+                seen.extend(m for m in ("Message 1", "Message 0", "First Message") if m in response.json["html"])
+                cursor = response.json["next"]
+            self.assert400(c.get(flask.url_for('ajax.event_messages', event=self.event.url_id, before="bad")))
+        self.assertEqual(seen, ["Message 3", "Message 2", "Message 1", "Message 0", "First Message"])
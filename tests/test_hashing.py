@@ -0,0 +1,46 @@
+# coding=utf-8
+import threading
+from unittest import TestCase
+
+import bcrypt
+import flask
+
+from event_app.hashing import PasswordHasher
+
+
+class TestPasswordHasher(TestCase):
+
+    def make_hasher(self, **config) -> PasswordHasher:
+        app = flask.Flask(__name__)
+        app.config.update(BCRYPT_LOG_ROUNDS=4, PASSWORD_HASH_MAX_ROUNDS=6, PASSWORD_HASH_TARGET_TIME=None,
+                          PASSWORD_HASH_WORKERS=0, PASSWORD_HASH_QUEUE_LIMIT=2)
+        app.config.update(config)
+        return PasswordHasher(app)
+
+    def test_hash_and_check(self):
+        hasher = self.make_hasher()
+        hashed = hasher.hash("password123")
+        self.assertTrue(hasher.check("password123", hashed))
+        self.assertFalse(hasher.check("password124", hashed))
+        self.assertTrue(bcrypt.checkpw(b"password123", hashed))
+        self.assertEqual(hasher.queue_depth, 0)
+
+    def test_process_pool(self):
+        hasher = self.make_hasher(PASSWORD_HASH_WORKERS=1)
+        self.assertTrue(hasher.check("password123", hasher.hash("password123")))
+
+    def test_calibration_is_clamped(self):
+        self.assertEqual(self.make_hasher(PASSWORD_HASH_TARGET_TIME=60).rounds, 6)
+        self.assertEqual(self.make_hasher(PASSWORD_HASH_TARGET_TIME=1e-9).rounds, 4)
+
+    def test_needs_rehash(self):
+        hasher = self.make_hasher(BCRYPT_LOG_ROUNDS=5)
+        self.assertTrue(hasher.needs_rehash(bcrypt.hashpw(b"password123", bcrypt.gensalt(4))))
+        self.assertFalse(hasher.needs_rehash(hasher.hash("password123")))
+
+    def test_saturation_logged(self):
+        hasher = self.make_hasher(PASSWORD_HASH_QUEUE_LIMIT=1)
+        hasher._slots.acquire()
+        threading.Timer(0.1, hasher._slots.release).start()
+        with self.assertLogs('event_app.hashing', 'WARNING'):
+            hasher.hash("password123")
@@ -0,0 +1,138 @@
+# coding=utf-8
+import pickle
+import socket
+import unittest
+from unittest import mock
+
+import flask
+import flask_mail
+
+from event_app import mailer
+from event_app.app import create_app
+from event_app.configs import TestingConfig
+from event_app.extensions import redis_store
+from event_app.mailer import BatchMailer
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:  # pragma: no cover
+    Controller = None
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        self.sessions.add(id(session))
+        return '250 OK'
+
+
+class RejectingHandler(RecordingHandler):
+    def __init__(self):
+        super().__init__()
+        self.attempts = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.attempts += 1
+        self.sessions.add(id(session))
+        return '554 Message rejected'
+
+
+@unittest.skipIf(Controller is None, "aiosmtpd is not installed")
+class TestBatchMailer(unittest.TestCase):
+
+    def setUp(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.handler = RecordingHandler()
+        self.controller = Controller(self.handler, hostname="127.0.0.1", port=self.port)
+        self.controller.start()
+
+        app = flask.Flask(__name__)
+        app.config.update(MAIL_SERVER="127.0.0.1", MAIL_PORT=self.port, MAIL_USE_SSL=False, MAIL_USE_TLS=False,
+                          MAIL_DEFAULT_SENDER="sender@example.com")
+        self.mail = flask_mail.Mail(app)
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        self.controller.stop()
+
+    @staticmethod
+    def message(i: int) -> flask_mail.Message:
+        return flask_mail.Message(subject=f"Message {i}", recipients=[f"user{i}@example.com"], body="Hello")
+
+    def test_batch_uses_one_connection(self):
+        with BatchMailer(self.mail) as mailer:
+            self.assertEqual(mailer.send_all([self.message(i) for i in range(5)]), 5)
+        self.assertEqual(len(self.handler.messages), 5)
+        self.assertEqual(len(self.handler.sessions), 1)
+
+    def test_reconnects_after_disconnect(self):
+        with BatchMailer(self.mail) as mailer:
+            mailer.send(self.message(0))
+            self.controller.stop()
+            self.controller = Controller(self.handler, hostname="127.0.0.1", port=self.port)
+            self.controller.start()
+            mailer.send(self.message(1))
+        self.assertEqual(len(self.handler.messages), 2)
+        self.assertEqual(len(self.handler.sessions), 2)
+
+    def test_rejection_not_resent(self):
+        self.controller.stop()
+        self.handler = RejectingHandler()
+        self.controller = Controller(self.handler, hostname="127.0.0.1", port=self.port)
+        self.controller.start()
+        with BatchMailer(self.mail) as mailer:
+            self.assertEqual(mailer.send_all([self.message(i) for i in range(2)]), 0)
+        self.assertEqual(self.handler.attempts, 2)
+        self.assertEqual(len(self.handler.sessions), 1)
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        app = create_app(TestingConfig)
+        app.config['MAIL_OUTBOX_ENABLED'] = True
+        self.context = app.app_context()
+        self.context.push()
+        redis_store.delete(mailer.OUTBOX_KEY, mailer.PROCESSING_KEY)
+
+    def tearDown(self):
+        redis_store.delete(mailer.OUTBOX_KEY, mailer.PROCESSING_KEY)
+        self.context.pop()
+
+    @staticmethod
+    def subjects(key: str):
+        return [pickle.loads(item).subject for item in redis_store.lrange(key, 0, -1)]
+
+    def test_batch_kept_until_sent(self):
+        mailer.queue_emails([TestBatchMailer.message(i) for i in range(3)])
+        batch = mailer.next_batch(2, 1)
+        self.assertEqual([pickle.loads(item).subject for item in batch], ["Message 0", "Message 1"])
+        self.assertEqual(redis_store.llen(mailer.PROCESSING_KEY), 2)
+
+        with self.subTest("Recovered after the worker stops"):
+            self.assertEqual(mailer.recover(), 2)
+            self.assertEqual(redis_store.llen(mailer.PROCESSING_KEY), 0)
+            self.assertEqual([pickle.loads(item).subject for item in mailer.next_batch(3, 1)],
+                             ["Message 0", "Message 1", "Message 2"])
+
+    def test_unsent_requeued_after_failure(self):
+        def send_all(messages, on_done):
+            on_done(0)
+            raise RuntimeError("Unexpected")
+
+        mailer.queue_emails([TestBatchMailer.message(i) for i in range(3)])
+        batch = mailer.next_batch(3, 1)
+        batch_mailer = mock.Mock(spec=BatchMailer)
+        batch_mailer.send_all.side_effect = send_all
+        with self.assertLogs(flask.current_app.logger, "ERROR"):
+            self.assertFalse(mailer.send_batch(batch_mailer, batch))
+        self.assertEqual(redis_store.llen(mailer.PROCESSING_KEY), 0)
+        self.assertEqual(self.subjects(mailer.OUTBOX_KEY), ["Message 2", "Message 1"])  # Taken from the end
@@ -1,8 +1,18 @@
 # coding=utf-8
+import io
+import os
+from datetime import datetime
 from unittest import TestCase, mock
 
+import flask
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
 import event_app
-from event_app import app, configs, utils
+from event_app import app, configs, geo, models, rendering, utils
+from event_app.extensions import db, redis_store
+from event_app.views.sse import forget_channel, get_channel, get_event_topic, get_replay_key, hash_channel, \
+    send_answer, send_message, sse, subscribed_topics
 
 
 class TestUtilities(TestCase):
@@ -29,3 +39,192 @@ class TestUtilities(TestCase):
                 self.assertEqual(response.status_code, 302)
                 self.assertEqual(response.location, "http://localhost/index")
                 self.assertTrue(url_for.called)
+
+    def test_cursor_round_trip(self):
+        values = [1.5, datetime(2018, 6, 1, 12, 30), "Event", 4]
+        cursor = utils.encode_cursor(values)
+        self.assertEqual(utils.decode_cursor(cursor, [float, datetime, str, int]), values)
+        with self.subTest("Tampered Cursor"):
+            with self.assertRaises(ValueError):
+                utils.decode_cursor(cursor, [float, datetime, str])
+            with self.assertRaises(ValueError):
+                utils.decode_cursor("not a cursor", [int])
+
+
+class TestGeography(TestCase):
+
+    def test_bounding_box_contains_circle(self):
+        min_lat, max_lat, min_lng, max_lng = models.bounding_box(-36.85, 174.76, 50)
+        self.assertAlmostEqual(max_lat - min_lat, 2 * 50 / geo.EARTH_RADIUS * 180 / 3.141592653589793)
+        self.assertLess(min_lng, 174.76)
+        self.assertGreater(max_lng, 174.76)
+
+    def test_bounding_box_edge_cases(self):
+        with self.subTest("Covers Pole"):
+            self.assertEqual(models.bounding_box(89.9, 0, 50)[1:], (90, None, None))
+        with self.subTest("Crosses Antimeridian"):
+            self.assertEqual(models.bounding_box(0, 179.9, 50)[2:], (None, None))
+
+
+class TestEventStream(TestCase):
+
+    def test_replay_after_last_event_id(self):
+        with event_app.app.create_app(configs.TestingConfig).app_context():
+            redis_store.delete(get_replay_key("EVENT#1"), get_replay_key("EVENT#2"))
+            sse.publish({"n": 1}, channel="EVENT#1")
+            last_event_id = int(redis_store.get('SSE:EVENT_ID'))
+            sse.publish({"n": 2}, channel="EVENT#1")
+            sse.publish({"n": 3}, channel="EVENT#2")
+            sse.publish({"n": 4}, channel="EVENT#3")
+
+            replayed = sse.replay(["EVENT#1", "EVENT#2"], last_event_id)
+            self.assertEqual([message.data["n"] for message in replayed], [2, 3])
+            self.assertEqual([message.id for message in replayed], sorted(message.id for message in replayed))
+
+    def test_published_once_per_event_topic(self):
+        with event_app.app.create_app(configs.TestingConfig).test_request_context():
+            db.create_all()
+            try:
+                owner = models.User("owner", "owner@example.com", "password123")
+                event = models.Event(owner=owner, name="Event", start=datetime.utcnow())
+                users = [models.User(f"user{i}", f"user{i}@example.com", "password123") for i in range(3)]
+                db.session.add_all(models.Subscription(user=user, event=event) for user in users)
+                message = models.EventMessage(event=event, type=models.MessageTypes.TEXT, data={"message": "Hi"})
+                question = models.Question(event=event, questioner=users[0], text="Question")
+                db.session.add_all([message, question])
+                db.session.commit()
+                topic = get_event_topic(event)
+
+                self.assertEqual(subscribed_topics(users[0]), [topic])
+                self.assertEqual(subscribed_topics(owner), [])
+                with mock.patch.object(sse, 'publish') as publish:
+                    send_message(message)
+                    publish.assert_called_once()
+                    self.assertEqual(publish.call_args[1]["channel"], topic)
+
+                with self.subTest("Answers"):
+                    question.answer = models.Answer(text="Public", private=False)
+                    with mock.patch.object(sse, 'publish') as publish:
+                        send_answer(question.answer)
+                        publish.assert_called_once()
+                        self.assertEqual(publish.call_args[1]["channel"], topic)
+
+                    question.answer.private = True
+                    with mock.patch.object(sse, 'publish') as publish:
+                        send_answer(question.answer)
+                        publish.assert_called_once()
+                        self.assertEqual(publish.call_args[1]["channel"], get_channel(users[0]))
+            finally:
+                db.session.remove()
+                db.drop_all()
+
+    def test_channel_memoised_until_forgotten(self):
+        user = models.User("jackson", "chadfield.jackson@gmail.com", "password123")
+        with event_app.app.create_app(configs.TestingConfig).app_context():
+            self.assertEqual(get_channel(user), hash_channel(user.email))
+            with mock.patch('event_app.views.sse.hash_channel') as hash_channel_mock:
+                get_channel(user)
+                self.assertFalse(hash_channel_mock.called)
+                forget_channel(user.email)
+                get_channel(user)
+                self.assertTrue(hash_channel_mock.called)
+
+
+class TestImageUploads(TestCase):
+
+    @staticmethod
+    def upload(width: int, height: int):
+        stream = io.BytesIO()
+        Image.new("RGB", (width, height)).save(stream, format="PNG")
+        stream.seek(0)
+        return FileStorage(stream, filename="image.png", content_type="image/png")
+
+    def test_spool_then_process(self):
+        with event_app.app.create_app(configs.TestingConfig).app_context():
+            with self.assertRaises(ValueError):
+                utils.spool_upload(self.upload(50, 50))
+
+            path = utils.spool_path(utils.spool_upload(self.upload(1200, 600)))
+            self.assertTrue(os.path.exists(path))
+            image = utils.save_image(path)
+            os.remove(path)
+            self.assertEqual(image["widths"], [320, 640, 800, 1200])
+
+            directory = os.path.join(flask.current_app.static_folder, configs.TestingConfig.UPLOAD_FOLDER)
+            with Image.open(os.path.join(directory, image["file"])) as saved:
+                self.assertEqual(saved.size, (1200, 600))
+
+            with self.subTest("Duplicate uploads share files"):
+                files = set(os.listdir(directory))
+                self.assertEqual(utils.save_image(self.upload(1200, 600)), image)
+                self.assertEqual(set(os.listdir(directory)), files)
+
+            self.remove_image(image["hash"])
+
+    def test_metadata_not_published(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation, rotated 90 degrees
+        exif[0x8825] = {2: (36.0, 51.0, 0.0)}  # GPSInfo, latitude
+        stream = io.BytesIO()
+        Image.new("RGB", (1200, 600)).save(stream, format="JPEG", exif=exif)
+        stream.seek(0)
+
+        with event_app.app.create_app(configs.TestingConfig).app_context():
+            image = utils.save_image(stream)
+            directory = os.path.join(flask.current_app.static_folder, configs.TestingConfig.UPLOAD_FOLDER)
+            published = [filename for filename in os.listdir(directory) if filename.startswith(image["hash"])]
+            self.assertTrue(all(filename.startswith(image["hash"] + "-") for filename in published))
+            self.assertEqual(image["widths"], [320, 600])
+            for filename in published:
+                with Image.open(os.path.join(directory, filename)) as saved:
+                    self.assertEqual(len(saved.getexif()), 0)
+                    self.assertGreater(saved.height, saved.width)  # Orientation applied
+                    self.assertEqual(str(saved.width), filename.rsplit(".", 1)[0].rsplit("-", 1)[1])
+            self.remove_image(image["hash"])
+
+    @staticmethod
+    def remove_image(digest: str):
+        for directory in (os.path.join(flask.current_app.static_folder, configs.TestingConfig.UPLOAD_FOLDER),
+                          os.path.join(flask.current_app.instance_path, configs.TestingConfig.IMAGE_ORIGINALS_FOLDER)):
+            for filename in os.listdir(directory):
+                if filename.startswith(digest):
+                    os.remove(os.path.join(directory, filename))
+
+
+class TestRendering(TestCase):
+
+    def test_render_cached_by_source(self):
+        source = "# Title\n\nSome *markdown* <script>alert(1)</script>"
+        with event_app.app.create_app(configs.TestingConfig).app_context():
+            redis_store.delete(rendering.cache_key(source))
+            html = rendering.render(source)
+            self.assertNotIn("<script>", html)
+            with mock.patch('event_app.rendering.render_uncached') as render_uncached:
+                self.assertEqual(rendering.render(source), html)
+                self.assertFalse(render_uncached.called)
+            self.assertEqual(rendering.render_uncached(source), html)  # Reused renderer is reset between calls
+
+    def test_rerender_all(self):
+        with event_app.app.create_app(configs.TestingConfig).app_context():
+            db.create_all()
+            try:
+                owner = models.User("owner", "owner@example.com", "password123")
+                event = models.Event(owner=owner, name="Event", start=datetime.utcnow(),
+                                     description="Stale", description_source="# Description")
+                legacy = models.Event(owner=owner, name="Legacy", start=datetime.utcnow(), description="Legacy")
+                message = models.EventMessage(event=event, type=models.MessageTypes.TEXT,
+                                              data={"message": "Stale", "source": "*Message*"})
+                legacy_message = models.EventMessage(event=event, type=models.MessageTypes.TEXT,
+                                                     data={"message": "Legacy"})
+                db.session.add_all([event, legacy, message, legacy_message])
+                db.session.commit()
+
+                self.assertEqual(rendering.rerender_all(workers=1), 2)
+                self.assertEqual(event.description, rendering.render_uncached("# Description"))
+                self.assertEqual(message.data["message"], rendering.render_uncached("*Message*"))
+                self.assertEqual(message.data["source"], "*Message*")
+                self.assertEqual(legacy.description, "Legacy")
+                self.assertEqual(legacy_message.data, {"message": "Legacy"})
+            finally:
+                db.session.remove()
+                db.drop_all()
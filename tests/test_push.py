@@ -0,0 +1,63 @@
+# coding=utf-8
+from unittest import TestCase, mock
+
+import flask
+
+from event_app.push import PushSender
+
+
+class TestPushSender(TestCase):
+
+    def setUp(self):
+        app = flask.Flask(__name__)
+        app.config.update(WEB_PUSH_PRIVATE_KEY="key", WEB_PUSH_SUBJECT="mailto:test@example.com",
+                          WEB_PUSH_CONCURRENCY=4, WEB_PUSH_TIMEOUT=1)
+        self.context = app.app_context()
+        self.context.push()
+        self.sender = PushSender(app)
+
+    def tearDown(self):
+        self.context.pop()
+
+    @staticmethod
+    def subscription(endpoint: str) -> dict:
+        return {"endpoint": endpoint, "keys": {"p256dh": "p256dh", "auth": "auth"}}
+
+    @mock.patch('event_app.push.Vapid')
+    @mock.patch('event_app.push.WebPusher')
+    def test_send_batch_reports_expired(self, web_pusher, vapid):
+        vapid.from_string.return_value.sign.return_value = {"Authorization": "vapid"}
+        statuses = {
+            "https://push.example.com/a": 201,
+            "https://push.example.com/b": 410,
+            "https://other.example.com/c": 404
+        }
+        web_pusher.side_effect = lambda info, requests_session: mock.Mock(**{
+            "send.return_value": mock.Mock(status_code=statuses[info["endpoint"]])
+        })
+
+        expired = self.sender.send_batch([self.subscription(endpoint) for endpoint in statuses], {"title": "a"})
+
+        self.assertEqual(sorted(expired), ["https://other.example.com/c", "https://push.example.com/b"])
+        with self.subTest("VAPID key parsed once, signed once per origin"):
+            vapid.from_string.assert_called_once_with(private_key="key")
+            self.assertEqual(vapid.from_string.return_value.sign.call_count, 2)
+        with self.subTest("One session per origin"):
+            self.assertEqual(len({call[1]["requests_session"] for call in web_pusher.call_args_list}), 2)
+
+    @mock.patch('event_app.push.Vapid')
+    @mock.patch('event_app.push.WebPusher')
+    def test_send_batch_continues_after_failure(self, web_pusher, vapid):
+        vapid.from_string.return_value.sign.return_value = {"Authorization": "vapid"}
+
+        def pusher(info, requests_session):
+            if info["endpoint"].endswith("/bad-keys"):
+                raise ValueError("Invalid p256dh")
+            return mock.Mock(**{"send.return_value": mock.Mock(status_code=410)})
+
+        web_pusher.side_effect = pusher
+        endpoints = ["https://push.example.com/bad-keys", "https://push.example.com/expired"]
+
+        expired = self.sender.send_batch([self.subscription(endpoint) for endpoint in endpoints], {"title": "a"})
+
+        self.assertEqual(expired, ["https://push.example.com/expired"])
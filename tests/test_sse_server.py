@@ -0,0 +1,139 @@
+# coding=utf-8
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+
+import flask
+
+from event_app.configs import TestingConfig
+from event_app.views.sse import get_replay_key
+
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import make_mocked_request
+    from event_app.sse_server import Client, StreamServer
+except ImportError:  # pragma: no cover
+    StreamServer = None
+
+
+class RecordingRedis:
+    def __init__(self):
+        self.subscribed = []
+        self.unsubscribed = []
+
+    async def subscribe(self, *channels):
+        self.subscribed.extend(channel.name.decode() for channel in channels)
+
+    async def unsubscribe(self, *channels):
+        self.unsubscribed.extend(channels)
+
+
+class ReplayingReceiver:
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def iter(self):
+        for channel, payload in self.messages:
+            yield SimpleNamespace(name=channel.encode()), payload
+
+
+@unittest.skipIf(StreamServer is None, "aiohttp is not installed")
+class TestStreamServer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        app = flask.Flask(__name__)
+        app.config.update(SECRET_KEY="secret", SSE_HEARTBEAT_INTERVAL=15, SSE_CLIENT_QUEUE_SIZE=2)
+        self.server = StreamServer(app)
+        self.server.redis = RecordingRedis()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_channels_shared_between_clients(self):
+        first = Client(["USER", "EVENT#1"], 2)
+        second = Client(["EVENT#1"], 2)
+        self.loop.run_until_complete(self.server.subscribe(first))
+        self.loop.run_until_complete(self.server.subscribe(second))
+        self.assertEqual(self.server.redis.subscribed, ["USER", "EVENT#1"])
+
+        self.loop.run_until_complete(self.server.unsubscribe(first))
+        self.assertEqual(self.server.redis.unsubscribed, ["USER"])
+        self.loop.run_until_complete(self.server.unsubscribe(second))
+        self.assertEqual(self.server.redis.unsubscribed, ["USER", "EVENT#1"])
+        self.assertEqual(len(self.server.clients), 0)
+
+    def test_slow_client_overflows(self):
+        client = Client(["USER"], 2)
+        client.offer(1, b"1")
+        client.offer(2, b"2")
+        self.assertFalse(client.overflowed)
+        client.offer(3, b"3")
+        self.assertTrue(client.overflowed)
+
+    def test_cancellation_propagates(self):
+        self.server.authorise = lambda session_cookie, requested_channel: [requested_channel]
+        request = make_mocked_request("GET", "/stream?channel=USER", headers={"Cookie": "session=cookie"})
+        stream = self.loop.create_task(self.server.handle_stream(request))
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(self.server.connections, 1)
+        stream.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(stream)
+        self.assertEqual(self.server.connections, 0)
+        self.assertEqual(self.server.redis.unsubscribed, ["USER"])
+
+    def test_malformed_events_skipped(self):
+        client = Client(["USER"], 10)
+        self.loop.run_until_complete(self.server.subscribe(client))
+        self.server.receiver = ReplayingReceiver([
+            ("USER", b"not json"),
+            ("USER", b'["not", "an", "event"]'),
+            ("USER", b'{"data": "valid", "id": 1}')
+        ])
+        with self.assertLogs(self.server.app.logger, "WARNING"):
+            self.loop.run_until_complete(self.server.dispatch())
+        self.assertEqual(client.queue.qsize(), 1)
+        self.assertEqual(client.queue.get_nowait()[0], 1)
+
+
+@unittest.skipIf(StreamServer is None, "aiohttp is not installed")
+class TestStreamServerRedis(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        app = flask.Flask(__name__)
+        app.config.update(SECRET_KEY="secret", SSE_HEARTBEAT_INTERVAL=15, SSE_CLIENT_QUEUE_SIZE=2,
+                          REDIS_URL=TestingConfig.REDIS_URL)
+        self.server = StreamServer(app)
+        self.application = web.Application()
+        self.loop.run_until_complete(self.server.on_startup(self.application))
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.server.on_cleanup(self.application))
+        self.loop.close()
+
+    def test_replay_while_subscribed(self):
+        key = get_replay_key("EVENT#1")
+
+        async def reconnect():
+            await self.server.pool.delete(key)
+            await self.server.pool.zadd(key, 1, json.dumps({"data": "seen", "id": 1}))
+            await self.server.pool.zadd(key, 2, json.dumps({"data": "missed", "id": 2}))
+            client = Client(["EVENT#1"], 2)
+            await self.server.subscribe(client)  # Puts the server's subscription connection into pub/sub mode
+            try:
+                replayed = await self.server.replay(["EVENT#1"], 1)
+                await self.server.pool.publish("EVENT#1", json.dumps({"data": "live", "id": 3}))
+                live = await asyncio.wait_for(client.queue.get(), timeout=5)
+            finally:
+                await self.server.unsubscribe(client)
+                await self.server.pool.delete(key)
+            return replayed, live
+
+        replayed, live = self.loop.run_until_complete(reconnect())
+        self.assertEqual([message.data for message in replayed], ["missed"])
+        self.assertEqual(live[0], 3)
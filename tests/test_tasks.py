@@ -0,0 +1,94 @@
+# coding=utf-8
+from datetime import datetime
+from unittest import mock
+
+import flask
+from flask_testing import TestCase
+
+from event_app import models, tasks
+from event_app.app import create_app
+from event_app.configs import TestingConfig
+from event_app.extensions import db
+from event_app.views.sse import get_channel
+
+
+class TestNotificationFanOut(TestCase):
+
+    def create_app(self) -> flask.app.Flask:
+        app = create_app(TestingConfig)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        owner = models.User("owner", "owner@example.com", "password123")
+        self.event = models.Event(owner=owner, name="Event", start=datetime.utcnow())
+        self.users = [models.User(f"user{i}", f"user{i}@example.com", "password123", email_verified=True)
+                      for i in range(5)]
+        self.users[0].email_notify = False
+        self.users[1].web_push_notify = False
+        for i, user in enumerate(self.users):
+            db.session.add(models.Subscription(user=user, event=self.event))
+            db.session.add(models.WebPushToken(endpoint=f"https://push.example.com/{i}", user=user,
+                                               p256dh="p256dh", auth="auth"))
+        db.session.commit()
+        self.app.config['NOTIFICATION_CHUNK_SIZE'] = 2
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_one_job_per_chunk(self):
+        recipients = models.User.query.join(
+                models.Subscription, models.Subscription.user_id == models.User.id
+        ).filter(models.Subscription.event_id == self.event.id)
+
+        with mock.patch('event_app.tasks.queue_emails') as queue_emails, \
+                mock.patch.object(tasks.send_push_notifications, 'queue') as queue_push:
+            count = tasks.fan_out(recipients, self.event, "Subject", "Body", {"title": "Event"})
+
+        self.assertEqual(count, 5)
+        self.assertEqual(queue_emails.call_count, 3)
+        self.assertEqual(queue_push.call_count, 3)
+        with self.subTest("Chunks respect NOTIFICATION_CHUNK_SIZE"):
+            self.assertTrue(all(len(call[0][0]) <= 2 for call in queue_emails.call_args_list))
+            self.assertTrue(all(len(call[0][0]) <= 2 for call in queue_push.call_args_list))
+        with self.subTest("Notification preferences respected"):
+            emailed = [message.recipients[0] for call in queue_emails.call_args_list for message in call[0][0]]
+            self.assertEqual(emailed, [f"user{i}@example.com" for i in range(1, 5)])
+            pushed = [endpoint for call in queue_push.call_args_list for endpoint in call[0][0]]
+            self.assertEqual(pushed, [f"https://push.example.com/{i}" for i in (0, 2, 3, 4)])
+        with self.subTest("Email rendered once and shared"):
+            bodies = {message.html for call in queue_emails.call_args_list for message in call[0][0]}
+            self.assertEqual(len(bodies), 1)
+
+
+class TestImageMessages(TestCase):
+
+    def create_app(self) -> flask.app.Flask:
+        app = create_app(TestingConfig)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        self.owner = models.User("owner", "owner@example.com", "password123")
+        self.event = models.Event(owner=self.owner, name="Event", start=datetime.utcnow())
+        db.session.add(self.event)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    @mock.patch('event_app.tasks.os.remove')
+    @mock.patch('event_app.tasks.notify')
+    @mock.patch('event_app.tasks.send_message')
+    @mock.patch('event_app.utils.save_image', return_value={"file": "a-320.jpeg", "hash": "a", "widths": [320]})
+    def test_owner_sees_processed_image(self, save_image, send_message, notify, remove):
+        tasks.process_image_message(self.event.id, "upload", "Title")
+
+        message = models.EventMessage.query.filter_by(event_id=self.event.id).one()
+        self.assertEqual(message.data["title"], "Title")
+        send_message.assert_called_once()
+        self.assertEqual(send_message.call_args[0][0].id, message.id)
+        self.assertEqual(send_message.call_args[1]["channel"], get_channel(self.owner))
+        notify.queue.assert_called_once_with("message", message.id)
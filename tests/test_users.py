@@ -1,12 +1,16 @@
 # coding=utf-8
+from datetime import datetime, timedelta
+
 import flask
 from flask_testing import TestCase
+from sqlalchemy import event as sqlalchemy_event
 
-from event_app import models
+from event_app import commands, models, utils
 from event_app.app import create_app
 from event_app.configs import TestingConfig
-from event_app.extensions import db, flask_login
-from event_app.forms import LoginForm, RegisterForm
+from event_app.extensions import db, flask_login, redis_store
+from event_app.forms import LoginForm, RecoveryPhase2Form, RegisterForm
+from event_app.lockout import login_lockout, recovery_lockout
 
 
 class TestUsersView(TestCase):
@@ -18,6 +22,7 @@ class TestUsersView(TestCase):
     def setUp(self):
         with self.app.app_context():
             db.create_all()
+        login_lockout.reset("127.0.0.1")
 
     def tearDown(self):
         db.session.remove()
@@ -123,6 +128,52 @@ class TestUsersView(TestCase):
             self.assertTrue(flask_login.current_user.is_anonymous)
             self.assertTemplateUsed('users/login.jinja')
 
+    def test_login_lockout(self):
+        self.app.config["LOCKDOWN_AFTER_N_PASSWORD_ATTEMPTS"] = 3
+        with self.client as c:
+            a = LoginForm()
+            db.session.add(models.User("jackson", "chadfield.jackson@gmail.com", "password123"))
+            db.session.commit()
+            for _ in range(3):
+                c.post(flask.url_for('users.login'), data={
+                    a.email.name   : "chadfield.jackson@gmail.com",
+                    a.password.name: "password12"
+                })
+                self.assertFalse(self.get_context_variable('lockout'))
+            c.post(flask.url_for('users.login'), data={
+                a.email.name   : "chadfield.jackson@gmail.com",
+                a.password.name: "password123"
+            })
+            self.assertTrue(self.get_context_variable('lockout'))
+            self.assertTrue(flask_login.current_user.is_anonymous)
+
+    def test_recovery_lockout(self):
+        self.app.config["RECOVERY_LOCKOUT_ATTEMPTS"] = 2
+        with self.client as c:
+            a = RecoveryPhase2Form()
+            db.session.add(models.User("jackson", "chadfield.jackson@gmail.com", "password123"))
+            db.session.commit()
+            redis_store.set("USER:RECOVERY_TOKEN#token", "chadfield.jackson@gmail.com")
+            recovery_lockout.reset("token")
+            for _ in range(2):
+                c.post(flask.url_for('users.recovery_change_password', token="token"), data={
+                    a.email.name           : "chadfield.jackson@gmail.com",
+                    a.first_name.name      : "jack",
+                    a.password.name        : "password456",
+                    a.confirm_password.name: "password456"
+                })
+                self.assertFalse(self.get_context_variable('lockout'))
+            c.post(flask.url_for('users.recovery_change_password', token="token"), data={
+                a.email.name           : "chadfield.jackson@gmail.com",
+                a.first_name.name      : "jackson",
+                a.password.name        : "password456",
+                a.confirm_password.name: "password456"
+            })
+            self.assertTrue(self.get_context_variable('lockout'))
+            self.assertTrue(flask_login.current_user.is_anonymous)
+            user = models.User.query.filter_by(email="chadfield.jackson@gmail.com").first()
+            self.assertTrue(user.check_password("password123"))
+
     def test_login_page_POST_invalid_password(self):
         with self.client as c:
             a = LoginForm()
@@ -143,3 +194,105 @@ class TestUsersView(TestCase):
                 self.assertIsNone(models.User.query.filter_by(email="chadfield.jacksongmail.com").first())
                 self.assertTrue(flask_login.current_user.is_anonymous)
                 self.assertTemplateUsed('users/login.jinja')
+
+    def test_unread_counters(self):
+        user = models.User("jackson", "chadfield.jackson@gmail.com", "password123")
+        owner = models.User("owner", "owner@example.com", "password123")
+        read, unread = (models.Event(owner=owner, name=name, start=datetime.utcnow()) for name in ("a", "b"))
+        viewed = datetime.utcnow() - timedelta(hours=1)
+        db.session.add_all([
+            models.Subscription(user=user, event=read, last_viewed=datetime.utcnow() + timedelta(hours=1)),
+            models.Subscription(user=user, event=unread, last_viewed=viewed)
+        ])
+        db.session.commit()
+        redis_store.delete(models.Subscription.unread_counter_key(user.id), models.Subscription.last_viewed_key(user.id))
+        event_ids = [read.id, unread.id]
+
+        messages = []
+        for i in range(3):
+            for event in (read, unread):
+                message = models.EventMessage(event=event, type=models.MessageTypes.TEXT,
+                                              data={"message": str(i)}, timestamp=viewed + timedelta(minutes=i))
+                db.session.add(message)
+                db.session.commit()
+                models.Subscription.count_unread_message(message)
+                messages.append(message)
+        self.assertEqual(models.Subscription.unread_counts(user.id, event_ids), {read.id: 0, unread.id: 2})
+
+        unread_messages = utils.get_unread_messages(user.id, event_ids)
+        self.assertEqual(list(unread_messages), [unread])
+        self.assertEqual(unread_messages[unread].count, 2)
+        self.assertEqual(unread_messages[unread].latest.data["message"], "2")
+
+        with self.subTest("Removed message"):
+            models.Subscription.count_unread_message(messages[-1], amount=-1)
+            self.assertEqual(models.Subscription.unread_counts(user.id, event_ids), {read.id: 0, unread.id: 1})
+
+        with self.subTest("Rebuilt from the database"):
+            redis_store.delete(models.Subscription.unread_counter_key(user.id))
+            result = self.app.test_cli_runner().invoke(commands.rebuild_unread_counters)
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(models.Subscription.unread_counts(user.id, event_ids), {read.id: 0, unread.id: 2})
+
+        with self.subTest("Reset"):
+            models.Subscription.reset_unread_count(user.id, unread.id)
+            self.assertEqual(models.Subscription.unread_counts(user.id, event_ids), {read.id: 0, unread.id: 0})
+            self.assertEqual(list(utils.get_unread_messages(user.id, event_ids)), [])
+
+        with self.subTest("Removed after being viewed"):
+            models.Subscription.mark_viewed(user.id, unread.id)
+            models.Subscription.count_unread_message(messages[-1], amount=-1)
+            self.assertIsNone(redis_store.hget(models.Subscription.unread_counter_key(user.id), unread.id))
+
+        with self.subTest("Buffered last viewed times"):
+            models.Subscription.mark_viewed(user.id, unread.id)
+            self.assertEqual(models.Subscription.query.get((user.id, unread.id)).last_viewed, viewed)
+
+            # Rebuilding flushes the buffer first, so the view isn't lost
+            result = self.app.test_cli_runner().invoke(commands.rebuild_unread_counters)
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(models.Subscription.unread_counts(user.id, event_ids), {read.id: 0, unread.id: 0})
+            db.session.expire_all()
+            self.assertGreater(models.Subscription.query.get((user.id, unread.id)).last_viewed, viewed)
+            self.assertEqual(models.Subscription.last_viewed_buffer(user.id), {})
+
+    def test_user_snapshot_cache(self):
+        user = models.User("jackson", "chadfield.jackson@gmail.com", "password123")
+        db.session.add(user)
+        db.session.commit()
+        token = user.session_token
+        redis_store.delete(models.User.snapshot_key(token))
+        db.session.expunge_all()
+
+        self.assertEqual(models.User.load_by_session_token(token).first_name, "jackson")
+        db.session.expunge_all()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy_event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            cached = models.User.load_by_session_token(token)
+            self.assertEqual(cached.email, "chadfield.jackson@gmail.com")
+        finally:
+            sqlalchemy_event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual(statements, [])
+        self.assertTrue(cached.check_password("password123"))  # Password fields load on demand
+
+        with self.subTest("Invalidated once the change commits"):
+            cached.first_name = "jack"
+            db.session.flush()
+            self.assertIsNotNone(redis_store.get(models.User.snapshot_key(token)))
+            db.session.commit()
+            self.assertIsNone(redis_store.get(models.User.snapshot_key(token)))
+
+        with self.subTest("Rolled back changes keep the snapshot"):
+            models.User.load_by_session_token(token)
+            cached = db.session.merge(cached)
+            cached.first_name = "jackson"
+            db.session.flush()
+            db.session.rollback()
+            self.assertIsNotNone(redis_store.get(models.User.snapshot_key(token)))
+            db.session.commit()
+            self.assertIsNotNone(redis_store.get(models.User.snapshot_key(token)))